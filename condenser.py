@@ -1,17 +1,24 @@
+import argparse
 import subprocess as sp
 import os
 import os.path as op
 import sys
 import shutil
-from typing import Optional, List, Tuple
+import socket
+from typing import Optional, List, Tuple, Sequence
 
-import pysrt
 from timeit import default_timer as timer
 import time
-import easygui as g
 import json
 import tempfile
 import re
+import zlib
+import math
+import bisect
+from contextlib import contextmanager
+from functools import lru_cache
+
+# easygui (which pulls in tkinter) and pysrt are imported where they are used, since they dominate the startup time
 
 
 class MediaError(Exception):
@@ -22,8 +29,11 @@ class SubtitleError(Exception):
     pass
 
 
-ffmpeg_cmd: str = "utils/ffmpeg/ffmpeg"
-ffprobe_cmd: str = "utils/ffmpeg/ffprobe"
+bundled_ffmpeg_cmd: str = "utils/ffmpeg/ffmpeg"
+bundled_ffprobe_cmd: str = "utils/ffmpeg/ffprobe"
+ffmpeg_cmd: str = bundled_ffmpeg_cmd
+ffprobe_cmd: str = bundled_ffprobe_cmd
+use_system_ffmpeg: bool = False
 video_exts: List[str] = [
     ".mkv",
     ".mp4",
@@ -59,16 +69,147 @@ fixed_output_dir_with_subfolders: bool = True
 output_condensed_subtitles: bool = False
 condensed_subtitles_format: str = "srt"
 padding: int = 500
+min_gap_to_bridge: int = 0
+max_period_length: int = 0
+min_period_duration: int = 0
+dry_run: bool = False
+benchmark_path: Optional[str] = None
+max_benchmark_samples: int = 100
+# Rough average bitrates (kbps) of ffmpeg's default encoders, used for estimating output sizes
+output_bitrates: dict = {"mp3": 128, "aac": 128, "m4a": 128, "ogg": 112, "opus": 96, "flac": 700, "wav": 1411}
+default_output_bitrate: int = 128
+# These formats ignore the bitrate option
+lossless_formats: List[str] = ["flac", "wav"]
+bitmap_subtitle_codecs: List[str] = ["hdmv_pgs_subtitle", "dvd_subtitle", "dvb_subtitle", "xsub"]
+# PGS "clear screen" display sets carry no image and are only a few dozen bytes
+bitmap_clear_packet_size: int = 64
+bitmap_default_duration: int = 3000
+# Cues without a duration are cut here, so that a missing clear packet does not keep a long silent gap
+bitmap_max_duration: int = 10000
+# Bump when the cue conversion changes, so that cached timings from older versions are not used
+bitmap_cache_version: int = 2
+bitmap_placeholder_text: str = "#"
+cache_dir: Optional[str] = None
+audio_channels: int = 0
+audio_sample_rate: int = 0
+boundary_fade: int = 0
+loudnorm: bool = False
+loudnorm_target: float = -16.0
+loudnorm_true_peak: float = -1.5
+loudnorm_lra: float = 11.0
+# loudnorm upsamples to 192 kHz internally, so the output rate has to be set when no audio_sample_rate is given
+loudnorm_default_sample_rate: int = 48000
+channel_layouts: dict = {1: "mono", 2: "stereo"}
+segment_duration: int = 0
+segment_playlist: bool = False
+output_chapters: bool = False
+extra_audio_streams: List[int] = []
+extra_subtitle_streams: List[int] = []
+extra_sub_suffixes: List[str] = []
+multi_track_output: str = "separate"
+output_timeline_map: bool = False
+encode_profile: Optional[str] = None
+# The default profiles only set the bitrate, which lossless formats ignore. "quality", "codec" and "compression_level"
+# have a different scale for each encoder, so they are left to be added for a specific output format
+encode_profiles: dict = {
+    "fast": {"intermediate_format": "pcm", "bitrate": "96k"},
+    "balanced": {"intermediate_format": "flac", "bitrate": "160k"},
+    "archival": {"intermediate_format": "flac", "bitrate": "320k"},
+}
+multi_stream_formats: List[str] = ["mka", "mkv", "m4a", "mp4", "mov", "webm", "ogg"]
+scratch_dir: Optional[str] = None
+use_ram_disk: bool = True
+ram_disk_dir: str = "/dev/shm"
+temp_budget_mb: int = 0
+workspace_poll_interval: float = 1.0
+watch_settle_time: float = 30.0
+watch_poll_interval: float = 10.0
+watch_use_inotify: bool = True
+default_audio_stream: int = 0
+default_subtitle_stream: int = 0
+# inotify events that mean a file in the watched folder was finished, moved in or out, or removed
+inotify_mask = 0x8 | 0x40 | 0x80 | 0x200  # IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+# Workspace folders are named condenser_temp-<host>-<pid>-<ms>-<reserved bytes> so that other processes can see the
+# reservation. The host is missing in workspaces left by older versions
+workspace_pattern = re.compile(r"^condenser_temp-(?:([A-Za-z0-9._]+)-)?(\d+)-(\d+)-(\d+)$")
+# A workspace is alive while its run holds the lock on this file
+workspace_lock_name = ".lock"
+# Workspaces that changed more recently than this are alive even without a lock, since they may still be created
+workspace_lock_grace: float = 60.0
+workspace_locks: dict = {}
 mulsrt_ask: bool = False
 
 
+@lru_cache(maxsize=None)
+def which(cmd: str) -> Optional[str]:
+    return shutil.which(cmd)
+
+
+def resolve_ffmpeg(use_system: bool) -> Tuple[str, str]:
+    if not use_system:
+        ffmpeg_path = which(bundled_ffmpeg_cmd)
+        ffprobe_path = which(bundled_ffprobe_cmd)
+        if ffmpeg_path and ffprobe_path:
+            return ffmpeg_path, ffprobe_path
+        print("ffmpeg or ffprobe not found in the utils/ffmpeg folder. Will try system ffmpeg")
+    ffmpeg_path = which("ffmpeg")
+    ffprobe_path = which("ffprobe")
+    if not ffmpeg_path or not ffprobe_path:
+        raise MediaError("Could not find ffmpeg and ffprobe. Make sure that they are in your system's PATH")
+    return ffmpeg_path, ffprobe_path
+
+
+def write_json(path: str, data, **options):
+    """Writes through a temporary file, so that runs at the same time never read a partial file"""
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(temp_path, "w", encoding="utf8") as f:
+            json.dump(data, f, **options)
+        os.replace(temp_path, path)
+    except BaseException:
+        if op.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+@lru_cache(maxsize=None)
+def check_binary(path: str) -> str:
+    """Returns the version line of an ffmpeg binary, cached in cache_dir until the binary changes"""
+    binaries_path = op.join(cache_dir, "binaries.json") if cache_dir is not None else None
+    binaries = {}
+    if binaries_path is not None and op.isfile(binaries_path):
+        try:
+            with open(binaries_path, "r", encoding="utf8") as f:
+                binaries = json.load(f)
+        except (OSError, ValueError):
+            binaries = {}
+
+    key = op.abspath(path)
+    mtime_ns = os.stat(path).st_mtime_ns
+    if key in binaries and binaries[key].get("mtime_ns") == mtime_ns:
+        return binaries[key]["version"]
+
+    result = sp.run([path, "-version"], capture_output=True)
+    if result.returncode != 0:
+        raise MediaError("Could not run {}: {}".format(path, result.stderr))
+    version = result.stdout.decode("utf8", errors="replace").partition("\n")[0]
+
+    if binaries_path is not None:
+        binaries[key] = {"mtime_ns": mtime_ns, "version": version}
+        os.makedirs(cache_dir, exist_ok=True)
+        write_json(binaries_path, binaries, indent=2)
+    return version
+
+
 def check_all_equal(li: List) -> bool:
     return li.count(li[0]) == len(li)
 
 
-def probe_video(filename: str) -> Tuple[List[dict], List[dict]]:
+def probe_video(filename: str) -> Tuple[List[dict], List[dict], Optional[int]]:
+    """Returns the audio streams, the subtitle streams and the duration in milliseconds (None if unknown)"""
     result = sp.run(
-        [ffprobe_cmd, "-show_streams", "-v", "quiet", "-print_format", "json", filename], capture_output=True
+        [ffprobe_cmd, "-show_streams", "-show_format", "-v", "quiet", "-print_format", "json", filename],
+        capture_output=True,
     )
     if result.returncode != 0:
         raise ValueError("Could not probe video " + filename + " with ffprobe: " + str(result.stderr))
@@ -76,7 +217,8 @@ def probe_video(filename: str) -> Tuple[List[dict], List[dict]]:
     streams = probe.get("streams")
     audio_streams = [s for s in streams if s.get("codec_type") == "audio"]
     subtitle_streams = [s for s in streams if s.get("codec_type") == "subtitle"]
-    return audio_streams, subtitle_streams
+    duration = probe.get("format", {}).get("duration")
+    return audio_streams, subtitle_streams, int(float(duration) * 1000) if duration is not None else None
 
 
 def streams_to_options(streams: List[dict]) -> List[str]:
@@ -114,6 +256,8 @@ def filter_text(text: str) -> str:
 
 
 def extract_periods(srt_path: str) -> List[List[int]]:
+    import pysrt
+
     subs = pysrt.open(srt_path)
     if not subs:
         raise SubtitleError("Could not open the subtitle file: " + srt_path)
@@ -121,6 +265,10 @@ def extract_periods(srt_path: str) -> List[List[int]]:
         for sub in subs:
             sub.text = filter_text(sub.text)
     periods = [[sub.start.ordinal - padding, sub.end.ordinal + padding] for sub in subs if len(sub.text) > 0]
+    if not periods:
+        raise SubtitleError("All lines in the subtitle file were filtered: " + srt_path)
+    # Lines are not guaranteed to be in order, e.g. in converted ass files
+    periods.sort()
 
     if periods[0][0] < 0:
         periods[0][0] = 0
@@ -132,73 +280,405 @@ def extract_periods(srt_path: str) -> List[List[int]]:
         expanded = 0
         for j in range(i + 1, len(periods)):
             # if periods[i][1] + padding >= periods[j][0]:  # has extra padding
+            # A line can end before the one it overlaps with, so the longer end is kept
             if periods[i][1] >= periods[j][0]:
-                periods[i][1] = periods[j][1]
+                periods[i][1] = max(periods[i][1], periods[j][1])
                 expanded += 1
             else:
                 break
         merged_periods.append(periods[i])
         i += expanded + 1
 
+    if min_gap_to_bridge > 0:
+        # Bridging a short gap costs a little extra audio but saves a separate extraction. This is done after merging
+        # the overlaps so that max_period_length is checked against the final period length
+        bridged_periods = [merged_periods[0]]
+        for start, end in merged_periods[1:]:
+            last = bridged_periods[-1]
+            if start - last[1] <= min_gap_to_bridge and (max_period_length <= 0 or end - last[0] <= max_period_length):
+                last[1] = end
+            else:
+                bridged_periods.append([start, end])
+        merged_periods = bridged_periods
+
+    # Zero-length lines without padding have no audio to extract
+    merged_periods = [p for p in merged_periods if p[1] - p[0] >= max(min_period_duration, 1)]
+    if not merged_periods:
+        raise SubtitleError("No periods left after dropping the ones shorter than min_period_duration")
+
     print("All period count: {} ({} filtered)".format(len(periods), len(subs) - len(periods)))
     print("Merged period count:", len(merged_periods))
     return merged_periods
 
 
-def extract_audio_parts(periods: List[List[int]], temp_dir: str, filename: str, audio_index: int) -> List[str]:
+def probe_duration(filename: str) -> Optional[int]:
+    """Returns the duration of the media file in milliseconds, or None if ffprobe cannot tell"""
+    result = sp.run(
+        [ffprobe_cmd, "-show_entries", "format=duration", "-v", "quiet", "-print_format", "json", filename],
+        capture_output=True,
+    )
+    if result.returncode != 0:
+        return None
+    duration = json.loads(result.stdout).get("format", {}).get("duration")
+    if duration is None:
+        return None
+    return int(float(duration) * 1000)
+
+
+def clip_periods(periods: List[List[int]], total_duration: Optional[int]) -> List[List[int]]:
+    """Drops the parts of the periods past the end of the media, since subtitles can outlast the audio"""
+    if not total_duration:
+        return periods
+    return [[start, min(end, total_duration)] for start, end in periods if start < total_duration]
+
+
+def period_stats(periods: List[List[int]], total_duration: Optional[int] = None) -> dict:
+    kept_duration = sum(end - start for start, end in periods)
+    compression_ratio = None
+    if total_duration:
+        compression_ratio = kept_duration / total_duration
+    return {
+        "period_count": len(periods),
+        "kept_duration": kept_duration,
+        "total_duration": total_duration,
+        "compression_ratio": compression_ratio,
+    }
+
+
+def load_benchmarks() -> List[dict]:
+    if benchmark_path is None or not op.isfile(benchmark_path):
+        return []
+    try:
+        with open(benchmark_path, "r", encoding="utf8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def record_benchmark(stats: dict, elapsed: float):
+    if benchmark_path is None:
+        return
+    samples = load_benchmarks()
+    samples.append(
+        {
+            "output_format": output_format,
+            "encode_profile": encode_profile,
+            "intermediate_format": intermediate_format_options()[0],
+            "period_count": stats["period_count"],
+            "kept_duration": stats["kept_duration"],
+            "elapsed": elapsed,
+        }
+    )
+    write_json(benchmark_path, samples[-max_benchmark_samples:], indent=2)
+
+
+def estimate_runtime(period_count: int, samples: List[dict]) -> Optional[float]:
+    """Estimates the runtime in seconds from previous runs, scaled by the period count"""
+    same_format = [s for s in samples if s.get("output_format") == output_format]
+    if same_format:
+        samples = same_format
+    # Profiles with raw PCM parts or a different encoder speed are not mixed in
+    same_profile = [s for s in samples if s.get("encode_profile") == encode_profile]
+    if same_profile:
+        samples = same_profile
+    total_periods = sum(s["period_count"] for s in samples)
+    if total_periods == 0:
+        return None
+    return period_count * sum(s["elapsed"] for s in samples) / total_periods
+
+
+def parse_bitrate(bitrate) -> Optional[float]:
+    """Returns an ffmpeg bitrate like "96k" or 96000 in kbps"""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kKmM]?)\s*", str(bitrate))
+    if not match:
+        return None
+    multiplier = {"": 0.001, "k": 1, "m": 1000}[match.group(2).lower()]
+    return float(match.group(1)) * multiplier
+
+
+def estimate_output_size(kept_duration: int) -> int:
+    bitrate = output_bitrates.get(output_format, default_output_bitrate)
+    profile_bitrate = parse_bitrate(active_encode_profile().get("bitrate"))
+    if profile_bitrate is not None and output_format not in lossless_formats:
+        bitrate = profile_bitrate
+    return int(kept_duration / 1000 * bitrate * 1000 / 8)
+
+
+def subtitle_source(sub_path: Optional[str]) -> str:
+    if sub_path is None:
+        return "embedded"
+    if op.splitext(sub_path)[1].lower() != ".srt":
+        return "converted"
+    return "external"
+
+
+def make_plan_entry(
+    filename: str, output_filename: str, audio_index: int, sub_path: Optional[str], sub_index: int, stats: dict
+) -> dict:
+    return {
+        "file": filename,
+        "output": output_filename,
+        "audio_index": audio_index,
+        "subtitle_source": subtitle_source(sub_path),
+        "subtitle_path": sub_path,
+        "subtitle_index": sub_index if sub_path is None else None,
+        **stats,
+        "expected_output_size": estimate_output_size(stats["kept_duration"]),
+        "estimated_runtime": estimate_runtime(stats["period_count"], load_benchmarks()),
+    }
+
+
+def write_plan(plan: List[dict], plan_path: str):
+    with open(plan_path, "w", encoding="utf8") as f:
+        json.dump(plan, f, indent=2)
+    print("Wrote plan for {} files to {}".format(len(plan), plan_path))
+
+
+def print_period_report(stats: dict):
+    print("Periods to extract:", stats["period_count"])
+    print("Kept duration: {:.2f} seconds".format(stats["kept_duration"] / 1000))
+    if stats["compression_ratio"] is not None:
+        print(
+            "Total duration: {:.2f} seconds (compression ratio {:.1%})".format(
+                stats["total_duration"] / 1000, stats["compression_ratio"]
+            )
+        )
+
+
+def part_audio_filters(duration: int) -> List[str]:
+    """Filters for every part, so that the loudness is measured on the audio that is encoded"""
+    filters = []
+    if audio_channels or audio_sample_rate:
+        options = []
+        if audio_sample_rate:
+            options.append("sample_rates={}".format(audio_sample_rate))
+        if audio_channels:
+            options.append("channel_layouts={}".format(channel_layouts[audio_channels]))
+        filters.append("aformat=" + ":".join(options))
+    fade = min(boundary_fade, duration // 2)
+    if fade > 0:
+        filters.append("afade=t=in:d={}".format(fade / 1000))
+        filters.append("afade=t=out:st={}:d={}".format((duration - fade) / 1000, fade / 1000))
+    if loudnorm:
+        filters.append("ebur128=framelog=quiet:peak=true")
+    return filters
+
+
+def parse_ebur128_summary(log: str) -> Optional[dict]:
+    integrated = re.search(r"I:\s+(-?[\d.]+|-inf) LUFS", log)
+    loudness_range = re.search(r"LRA:\s+(-?[\d.]+) LU", log)
+    true_peak = re.search(r"Peak:\s+(-?[\d.]+|-inf) dBFS", log)
+    if not integrated or not loudness_range or not true_peak:
+        return None
+    return {
+        "I": float(integrated.group(1)),
+        "LRA": float(loudness_range.group(1)),
+        "TP": float(true_peak.group(1)),
+    }
+
+
+def parse_ebur128_summaries(log: str) -> List[Optional[dict]]:
+    """Parses the summary of every ebur128 filter in an ffmpeg log, in the order of the outputs"""
+    return [parse_ebur128_summary(summary) for summary in log.split("Summary:")[1:]]
+
+
+def combine_loudness(measurements: List[Optional[dict]], durations: List[int]) -> Optional[dict]:
+    """Approximates the loudness of the concatenated parts from the loudness of each part"""
+    measured = [(m, d) for m, d in zip(measurements, durations, strict=True) if m is not None and m["I"] > -70]
+    if not measured:
+        return None
+    total_duration = sum(d for _, d in measured)
+    energy = sum(d * 10 ** (m["I"] / 10) for m, d in measured) / total_duration
+    integrated = 10 * math.log10(energy)
+    return {
+        "I": integrated,
+        "LRA": sum(d * m["LRA"] for m, d in measured) / total_duration,
+        "TP": max(m["TP"] for m, _ in measured),
+        # The relative gate of EBU R128 is 10 LU below the integrated loudness
+        "thresh": integrated - 10,
+    }
+
+
+def loudnorm_filter(loudness: Optional[dict]) -> str:
+    """Two-pass (linear) loudnorm if the loudness was measured during extraction, single-pass otherwise"""
+    options = ["I={}".format(loudnorm_target), "TP={}".format(loudnorm_true_peak), "LRA={}".format(loudnorm_lra)]
+    if loudness is not None:
+        options += [
+            "measured_I={:.2f}".format(loudness["I"]),
+            "measured_TP={:.2f}".format(loudness["TP"]),
+            "measured_LRA={:.2f}".format(loudness["LRA"]),
+            "measured_thresh={:.2f}".format(loudness["thresh"]),
+            "linear=true",
+        ]
+    return "loudnorm=" + ":".join(options)
+
+
+def active_encode_profile() -> dict:
+    if encode_profile is None:
+        return {}
+    return encode_profiles[encode_profile]
+
+
+def intermediate_format_options() -> Tuple[str, List[str]]:
+    """Returns the extension and ffmpeg options for the extracted parts"""
+    if active_encode_profile().get("intermediate_format") == "pcm":
+        return "wav", ["-c:a", "pcm_s16le"]
+    return "flac", ["-c:a", "flac", "-compression_level", "0"]
+
+
+def encode_options() -> List[str]:
+    """Returns the ffmpeg options of the final encode for the active encode profile"""
+    profile = active_encode_profile()
+    option_names = {
+        "codec": "-c:a",
+        "bitrate": "-b:a",
+        "quality": "-q:a",
+        "compression_level": "-compression_level",
+        "sample_format": "-sample_fmt",
+        "threads": "-threads",
+    }
+    options = []
+    for key, option in option_names.items():
+        if profile.get(key) is not None:
+            options += [option, str(profile[key])]
+    return options
+
+
+def extract_audio_parts(
+    periods: List[List[int]], temp_dir: str, filename: str, audio_indices: List[int]
+) -> Tuple[List[List[str]], List[Optional[dict]]]:
+    """Returns the part paths of each audio stream and its loudness if loudnorm is enabled"""
     print("Extracting...")
-    out_paths = []
+    out_paths = [[] for _ in audio_indices]
+    measurements = [[] for _ in audio_indices]
+    part_ext, part_options = intermediate_format_options()
     for i, (start, end) in enumerate(periods):
-        out_path = temp_dir + "/out_{}.flac".format(i)
-        out_paths.append(out_path)
         command = [
             ffmpeg_cmd,
             "-hide_banner",
             "-loglevel",
-            "error",
+            "info" if loudnorm else "error",
             "-ss",
             str(start / 1000),
             "-i",
             filename,
-            "-t",
-            str((end - start) / 1000),
-            "-map",
-            "0:a:{}".format(audio_index),
-            "-c:a",
-            "flac",
-            "-compression_level",
-            "0",
-            out_path,
         ]
-        rc = sp.call(command, shell=False)
-        if rc != 0:
+        if loudnorm:
+            command.append("-nostats")
+        filters = part_audio_filters(end - start)
+        for track, audio_index in enumerate(audio_indices):
+            out_path = temp_dir + "/out_{}_{}.{}".format(track, i, part_ext)
+            out_paths[track].append(out_path)
+            command += ["-t", str((end - start) / 1000), "-map", "0:a:{}".format(audio_index)]
+            if filters:
+                command += ["-af", ",".join(filters)]
+            command += part_options + [out_path]
+        result = sp.run(command, stderr=sp.PIPE if loudnorm else None)
+        if result.returncode != 0:
             raise MediaError("Could not extract audio from video")
+        if loudnorm:
+            summaries = parse_ebur128_summaries(result.stderr.decode("utf8", errors="replace"))
+            summaries += [None] * (len(audio_indices) - len(summaries))
+            for track in range(len(audio_indices)):
+                measurements[track].append(summaries[track])
 
         print("{}/{}".format(i + 1, len(periods)), end="\r")
-    return out_paths
+
+    durations = [end - start for start, end in periods]
+    loudness = [combine_loudness(m, durations) if loudnorm else None for m in measurements]
+    return out_paths, loudness
 
 
-def concatenate_audio_parts(periods: List[List[int]], temp_dir: str, out_paths: List[str], output_filename: str):
-    concat_dir = op.join(temp_dir, "concat.txt")
-    with open(concat_dir, "w") as f:
-        for i in range(len(periods)):
-            f.write("file '{}'\n".format(out_paths[i].replace("'", "'\\''")))
+def segment_cuts(periods: List[List[int]]) -> List[int]:
+    """Returns the condensed times in milliseconds where a new segment starts"""
+    cuts = []
+    offset = 0
+    segment_start = 0
+    for start, end in periods[:-1]:
+        offset += end - start
+        if offset - segment_start >= segment_duration * 1000:
+            cuts.append(offset)
+            segment_start = offset
+    return cuts
+
+
+def segment_path(path: str, index: int) -> str:
+    root, ext = op.splitext(path)
+    return "{}_{:03d}{}".format(root, index, ext)
+
+
+def format_timestamp(ms: int) -> str:
+    return "{:02d}:{:02d}:{:02d}".format(ms // 3600000, ms // 60000 % 60, ms // 1000 % 60)
+
+
+def write_chapters(periods: List[List[int]], metadata_path: str):
+    """Writes an ffmetadata file with a chapter for each period, titled with the period's time in the source"""
+    with open(metadata_path, "w", encoding="utf8") as f:
+        f.write(";FFMETADATA1\n")
+        offset = 0
+        for start, end in periods:
+            f.write("[CHAPTER]\nTIMEBASE=1/1000\nSTART={}\nEND={}\n".format(offset, offset + end - start))
+            f.write("title={}\n".format(format_timestamp(start)))
+            offset += end - start
+
+
+def concatenate_audio_parts(
+    periods: List[List[int]],
+    temp_dir: str,
+    out_paths: List[List[str]],
+    output_filename: str,
+    loudness: Optional[List[Optional[dict]]] = None,
+):
+    """Concatenates the parts of each audio stream into one output, with a stream for each of them"""
+    if loudness is None:
+        loudness = [None] * len(out_paths)
 
     print("Concatenating...")
-    concat_commands = [
-        ffmpeg_cmd,
-        "-y",
-        "-safe",
-        "0",
-        "-hide_banner",
-        "-loglevel",
-        "error",
-        "-f",
-        "concat",
-        "-i",
-        concat_dir,
-        output_filename,
-    ]
+    concat_commands = [ffmpeg_cmd, "-y", "-hide_banner", "-loglevel", "error"]
+    for track, track_paths in enumerate(out_paths):
+        concat_dir = op.join(temp_dir, "concat_{}.txt".format(track))
+        with open(concat_dir, "w") as f:
+            for i in range(len(periods)):
+                f.write("file '{}'\n".format(track_paths[i].replace("'", "'\\''")))
+        concat_commands += ["-safe", "0", "-f", "concat", "-i", concat_dir]
+
+    with_chapters = output_chapters and segment_duration <= 0
+    if with_chapters:
+        metadata_path = op.join(temp_dir, "chapters.txt")
+        write_chapters(periods, metadata_path)
+        concat_commands += ["-i", metadata_path, "-map_chapters", str(len(out_paths))]
+    if with_chapters or len(out_paths) > 1:
+        for track in range(len(out_paths)):
+            concat_commands += ["-map", "{}:a".format(track)]
+    if loudnorm:
+        if len(out_paths) == 1:
+            concat_commands += ["-af", loudnorm_filter(loudness[0])]
+        else:
+            for track in range(len(out_paths)):
+                concat_commands += ["-filter:a:{}".format(track), loudnorm_filter(loudness[track])]
+        concat_commands += ["-ar", str(audio_sample_rate or loudnorm_default_sample_rate)]
+    concat_commands += encode_options()
+    if segment_duration > 0:
+        # Segments are written by the same encode, so there is no separate splitting pass
+        concat_commands += ["-f", "segment", "-reset_timestamps", "1"]
+        cuts = segment_cuts(periods)
+        if cuts:
+            concat_commands += ["-segment_times", ",".join(str(c / 1000) for c in cuts)]
+        else:
+            # Without cuts the muxer would split every 2 seconds, so a single segment spans the whole output
+            total = sum(end - start for start, end in periods)
+            concat_commands += ["-segment_time", str(total // 1000 + 1)]
+        if segment_playlist:
+            concat_commands += [
+                "-segment_list",
+                op.splitext(output_filename)[0] + ".m3u8",
+                "-segment_list_type",
+                "m3u8",
+            ]
+        root, ext = op.splitext(output_filename)
+        concat_commands.append(root.replace("%", "%%") + "_%03d" + ext)
+    else:
+        concat_commands.append(output_filename)
     result = sp.run(concat_commands, capture_output=True)
     if result.returncode != 0:
         raise MediaError("There was a problem during concatenation: " + str(result.stderr))
@@ -207,6 +687,8 @@ def concatenate_audio_parts(periods: List[List[int]], temp_dir: str, out_paths:
 def choose_audio_stream(audio_streams: List[dict], message: str) -> int:
     audio_index = 0
     if len(audio_streams) > 1:
+        import easygui as g
+
         audio_options = streams_to_options(audio_streams)
         audio_index = g.indexbox(
             message, "Audio Stream", audio_options, default_choice=audio_options[audio_index], cancel_choice="cancel"
@@ -219,6 +701,8 @@ def choose_audio_stream(audio_streams: List[dict], message: str) -> int:
 def choose_subtitle_stream(subtitle_streams: List[dict], file_name_str: str = "this file") -> int:
     sub_index = 0
     if len(subtitle_streams) > 1 and mulsrt_ask:
+        import easygui as g
+
         sub_options = streams_to_options(subtitle_streams)
         sub_index = g.indexbox(
             "No external and multiple internal subtitles found in {}. Which one would you like to use?".format(
@@ -234,8 +718,115 @@ def choose_subtitle_stream(subtitle_streams: List[dict], file_name_str: str = "t
     return sub_index
 
 
-def extract_srt(temp_dir: str, filename: str, sub_index: int) -> str:
-    srt_path = op.join(temp_dir, "out.srt")
+def bitmap_packets_to_cues(packets: List[dict]) -> List[List[int]]:
+    """Turns ffprobe subtitle packets into [start, end] cues in milliseconds"""
+    timed_packets = []
+    for packet in packets:
+        if "pts_time" not in packet:
+            continue
+        start = int(float(packet["pts_time"]) * 1000)
+        duration = int(float(packet.get("duration_time", 0)) * 1000)
+        timed_packets.append((start, duration, int(packet.get("size", 0))))
+    timed_packets.sort()
+
+    cues = []
+    for i, (start, duration, size) in enumerate(timed_packets):
+        if size <= bitmap_clear_packet_size:
+            continue
+        if duration > 0:
+            end = start + duration
+        elif i + 1 < len(timed_packets):
+            end = min(timed_packets[i + 1][0], start + bitmap_max_duration)
+        else:
+            end = start + bitmap_default_duration
+        if end > start:
+            cues.append([start, end])
+    return cues
+
+
+def probe_bitmap_subtitle_cues(filename: str, sub_index: int) -> List[List[int]]:
+    result = sp.run(
+        [
+            ffprobe_cmd,
+            "-v",
+            "quiet",
+            "-select_streams",
+            "s:{}".format(sub_index),
+            "-show_entries",
+            "packet=pts_time,duration_time,size",
+            "-print_format",
+            "json",
+            filename,
+        ],
+        capture_output=True,
+    )
+    if result.returncode != 0:
+        raise MediaError("Could not read subtitle packets with ffprobe: " + str(result.stderr))
+    return bitmap_packets_to_cues(json.loads(result.stdout).get("packets", []))
+
+
+def bitmap_cache_path(filename: str, sub_index: int) -> Optional[str]:
+    if cache_dir is None:
+        return None
+    stat = os.stat(filename)
+    cue_options = "{}-{}-{}-{}-{}".format(
+        bitmap_cache_version,
+        bitmap_clear_packet_size,
+        bitmap_default_duration,
+        bitmap_max_duration,
+        bitmap_placeholder_text,
+    )
+    key = "{:08x}-{}-{}-{}-{:08x}".format(
+        zlib.crc32(op.abspath(filename).encode("utf8")),
+        stat.st_size,
+        stat.st_mtime_ns,
+        sub_index,
+        zlib.crc32(cue_options.encode("utf8")),
+    )
+    return op.join(cache_dir, key + ".srt")
+
+
+def extract_bitmap_srt(temp_dir: str, filename: str, sub_index: int, srt_name: str = "out.srt") -> str:
+    """Writes an srt with placeholder text from the timings of bitmap subtitle packets"""
+    import pysrt
+
+    srt_path = op.join(temp_dir, srt_name)
+    cached_path = bitmap_cache_path(filename, sub_index)
+    if cached_path is not None and op.isfile(cached_path):
+        print("Using cached bitmap subtitle timings")
+        shutil.copy(cached_path, srt_path)
+        return srt_path
+
+    print("Reading bitmap subtitle timings...")
+    cues = probe_bitmap_subtitle_cues(filename, sub_index)
+    if not cues:
+        raise SubtitleError("Could not find any timings in the bitmap subtitle stream of " + filename)
+    subs = pysrt.SubRipFile()
+    for i, (start, end) in enumerate(cues):
+        subs.append(
+            pysrt.SubRipItem(
+                i + 1,
+                start=pysrt.SubRipTime(milliseconds=start),
+                end=pysrt.SubRipTime(milliseconds=end),
+                text=bitmap_placeholder_text,
+            )
+        )
+    subs.save(srt_path, encoding="utf-8")
+
+    if cached_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Copied under a temporary name first, so that runs at the same time never read a partial file
+        temp_path = "{}.{}.tmp".format(cached_path, os.getpid())
+        shutil.copy(srt_path, temp_path)
+        os.replace(temp_path, cached_path)
+    return srt_path
+
+
+def extract_srt(temp_dir: str, filename: str, sub_index: int, codec_name: str = "", srt_name: str = "out.srt") -> str:
+    if codec_name in bitmap_subtitle_codecs:
+        return extract_bitmap_srt(temp_dir, filename, sub_index, srt_name)
+
+    srt_path = op.join(temp_dir, srt_name)
     result = sp.run(
         [
             ffmpeg_cmd,
@@ -255,10 +846,12 @@ def extract_srt(temp_dir: str, filename: str, sub_index: int) -> str:
     return srt_path
 
 
-def find_subtitle_with_same_name_as_file(filename: str) -> Optional[str]:
+def find_subtitle_with_same_name_as_file(filename: str, suffix: Optional[str] = None) -> Optional[str]:
+    if suffix is None:
+        suffix = sub_suffix
     file_root, _ = op.splitext(filename)
     for e in sub_exts[:-1]:
-        path = file_root + sub_suffix + e[1:]
+        path = file_root + suffix + e[1:]
         if op.isfile(path):
             return path
     return None
@@ -276,7 +869,10 @@ def find_matching_subtitles_for_files(filenames: List[str]) -> Tuple[List[str],
     return all_subtitle_paths, invalid_videos
 
 
-def get_srt(subtitle_streams: List[dict], file_folder: str, filename: str, temp_dir: str) -> str:
+def get_srt(
+    subtitle_streams: List[dict], file_folder: str, filename: str, temp_dir: str, interactive: bool = True
+) -> Tuple[str, Optional[str], int]:
+    """Returns the srt path to use, the original subtitle file path (None if embedded) and the subtitle stream index"""
     sub_path = find_subtitle_with_same_name_as_file(filename)
 
     if sub_path is None:
@@ -284,11 +880,18 @@ def get_srt(subtitle_streams: List[dict], file_folder: str, filename: str, temp_
 
         if len(subtitle_streams) >= 1:
             # Video has subtitles
-            sub_index = choose_subtitle_stream(subtitle_streams)
-            srt_path = extract_srt(temp_dir, filename, sub_index)
-            return srt_path
+            if interactive:
+                sub_index = choose_subtitle_stream(subtitle_streams)
+            else:
+                sub_index = configured_stream_index(default_subtitle_stream, subtitle_streams)
+            srt_path = extract_srt(temp_dir, filename, sub_index, subtitle_streams[sub_index].get("codec_name", ""))
+            return srt_path, None, sub_index
+        elif not interactive:
+            raise ValueError("Video file has no subtitles and no subtitle file with the same name: " + filename)
         else:
             # No subs in video either, asking the user
+            import easygui as g
+
             sub_path = g.fileopenbox(
                 "This video file has no subtitles. Select a subtitle file to continue",
                 title,
@@ -298,13 +901,13 @@ def get_srt(subtitle_streams: List[dict], file_folder: str, filename: str, temp_
             if sub_path is None:
                 raise ValueError("Video file has no subtitles and subtitle file not selected. Exiting program.")
 
-    return convert_sub_if_needed(sub_path, temp_dir)
+    return convert_sub_if_needed(sub_path, temp_dir), sub_path, 0
 
 
-def convert_sub_if_needed(sub_path: str, temp_dir: str) -> str:
+def convert_sub_if_needed(sub_path: str, temp_dir: str, srt_name: str = "out.srt") -> str:
     sub_root, sub_ext = op.splitext(sub_path)
     if sub_ext.lower() != ".srt":
-        srt_path = op.join(temp_dir, "out.srt")
+        srt_path = op.join(temp_dir, srt_name)
         sub_convert_cmd = [ffmpeg_cmd, "-i", sub_path, srt_path]
         result = sp.run(sub_convert_cmd, capture_output=True)
         if result.returncode != 0:
@@ -314,45 +917,336 @@ def convert_sub_if_needed(sub_path: str, temp_dir: str) -> str:
     return srt_path
 
 
-def condense(srt_path: str, temp_dir: str, filename: str, audio_index: int, output_filename: str):
+def get_extra_srts(filename: str, subtitle_streams: List[dict], temp_dir: str) -> List[Tuple[str, str]]:
+    """Returns (srt path, output name suffix) for each extra subtitle that is condensed along with the main one"""
+    extra_srts = []
+    for sub_index in extra_subtitle_streams:
+        if sub_index >= len(subtitle_streams):
+            print("{} has no subtitle stream {}. Skipping".format(filename, sub_index + 1))
+            continue
+        codec_name = subtitle_streams[sub_index].get("codec_name", "")
+        srt_path = extract_srt(temp_dir, filename, sub_index, codec_name, "extra_{}.srt".format(sub_index))
+        extra_srts.append((srt_path, "_sub{}".format(sub_index + 1)))
+    for i, suffix in enumerate(extra_sub_suffixes):
+        sub_path = find_subtitle_with_same_name_as_file(filename, suffix)
+        if sub_path is None:
+            print("No subtitle file with suffix {} found for {}. Skipping".format(suffix, filename))
+            continue
+        extra_srts.append((convert_sub_if_needed(sub_path, temp_dir, "extra_suffix_{}.srt".format(i)), suffix))
+    return extra_srts
+
+
+def get_extra_audio_indices(audio_index: int, audio_streams: List[dict]) -> List[int]:
+    return [i for i in extra_audio_streams if i != audio_index and i < len(audio_streams)]
+
+
+def track_output_path(output_filename: str, audio_index: int) -> str:
+    root, ext = op.splitext(output_filename)
+    return "{}_track{}{}".format(root, audio_index + 1, ext)
+
+
+def estimate_workspace_size(total_duration: Optional[int], audio_streams: List[dict]) -> Optional[int]:
+    """Upper bound for the 16-bit PCM parts of all streams, or None if the duration is unknown"""
+    if not total_duration:
+        return None
+    stream_rates = [int(a.get("sample_rate", 48000)) * int(a.get("channels", 2)) * 2 for a in audio_streams]
+    # The selected stream is not known yet, so the largest one is assumed
+    bytes_per_second = max(stream_rates, default=48000 * 2 * 2)
+    bytes_per_second += sum(stream_rates[i] for i in set(extra_audio_streams) if 0 <= i < len(stream_rates))
+    return int(total_duration / 1000 * bytes_per_second)
+
+
+def workspace_roots() -> List[str]:
+    """Candidate folders for workspaces, from the fastest to the always available fallback"""
+    roots = []
+    if scratch_dir is not None:
+        roots.append(scratch_dir)
+    if use_ram_disk and op.isdir(ram_disk_dir):
+        roots.append(ram_disk_dir)
+    roots.append(tempfile.gettempdir())
+    return roots
+
+
+def lock_file(f) -> bool:
+    try:
+        if sys.platform == "win32":
+            import msvcrt
+
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+def is_workspace_alive(path: str) -> bool:
+    """Checks the lock of the workspace instead of its pid, which can be reused or belong to another pid namespace"""
+    if path in workspace_locks:
+        return True
+    try:
+        if time.time() - op.getmtime(path) < workspace_lock_grace:
+            return True
+        with open(op.join(path, workspace_lock_name), "r+b") as f:
+            return not lock_file(f)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        return True
+
+
+def list_workspaces(root: str) -> List[Tuple[str, int, int]]:
+    """Returns (path, pid, reserved bytes) of the workspaces in root"""
+    if not op.isdir(root):
+        return []
+    workspaces = []
+    for name in os.listdir(root):
+        match = workspace_pattern.match(name)
+        if match:
+            workspaces.append((op.join(root, name), int(match.group(2)), int(match.group(4))))
+    return workspaces
+
+
+def cleanup_orphaned_workspaces():
+    for root in workspace_roots():
+        for path, _, _ in list_workspaces(root):
+            if not is_workspace_alive(path):
+                print("Removing orphaned workspace", path)
+                shutil.rmtree(path, ignore_errors=True)
+
+
+def reserved_bytes(root: str) -> int:
+    return sum(reserved for _, _, reserved in list_workspaces(root))
+
+
+def workspace_order(path: str) -> Tuple[int, int, str]:
+    """Workspaces are served in the order they were created, by creation time, then pid"""
+    match = workspace_pattern.match(op.basename(path))
+    return int(match.group(3)), int(match.group(2)), op.basename(path)
+
+
+def reserved_bytes_ahead(path: str) -> List[int]:
+    """Returns the reserved bytes of the workspaces that were created before the one at path"""
+    order = workspace_order(path)
+    reserved_ahead = []
+    for root in set(workspace_roots()):
+        for other_path, _, reserved in list_workspaces(root):
+            if workspace_order(other_path) < order:
+                reserved_ahead.append(reserved)
+    return reserved_ahead
+
+
+def acquire_workspace(estimated_size: Optional[int], wait_for_budget: bool = True) -> str:
+    """Creates a workspace in the fastest root with room for it, waiting for temp_budget_mb"""
+    roots = workspace_roots()
+    chosen_root = roots[-1]
+    if estimated_size is not None:
+        for root in roots[:-1]:
+            try:
+                free = shutil.disk_usage(root).free
+            except OSError:
+                continue
+            if free - reserved_bytes(root) >= estimated_size:
+                chosen_root = root
+                break
+
+    host = re.sub(r"[^A-Za-z0-9.]", "_", socket.gethostname()) or "host"
+    name = "condenser_temp-{}-{}-{}-{}".format(host, os.getpid(), int(time.time() * 1000), estimated_size or 0)
+    path = op.join(chosen_root, name)
+    os.makedirs(path)
+    lock = open(op.join(path, workspace_lock_name), "a+b")
+    workspace_locks[path] = lock
+    lock_file(lock)
+
+    # The reservation is made before checking the budget, so that jobs started together see each other. A job waits
+    # only while some job is ahead of it
+    budget = temp_budget_mb * 1024 * 1024 if wait_for_budget else 0
+    try:
+        while budget > 0:
+            cleanup_orphaned_workspaces()
+            reserved_ahead = reserved_bytes_ahead(path)
+            if not reserved_ahead or sum(reserved_ahead) + (estimated_size or 0) <= budget:
+                break
+            print("Waiting for other jobs to free up temporary space...", end="\r")
+            time.sleep(workspace_poll_interval)
+    except BaseException:
+        release_workspace(path)
+        raise
+    return path
+
+
+def release_workspace(path: str):
+    lock = workspace_locks.pop(path, None)
+    if lock is not None:
+        lock.close()
+    shutil.rmtree(path, ignore_errors=True)
+
+
+@contextmanager
+def workspace(estimated_size: Optional[int], wait_for_budget: bool = True):
+    path = acquire_workspace(estimated_size, wait_for_budget)
+    try:
+        yield path
+    finally:
+        release_workspace(path)
+
+
+def condense(
+    srt_path: str,
+    temp_dir: str,
+    filename: str,
+    audio_index: int,
+    output_filename: str,
+    total_duration: Optional[int] = None,
+    extra_audio_indices: Sequence[int] = (),
+    extra_srts: Sequence[Tuple[str, str]] = (),
+    plan_only: bool = False,
+) -> dict:
+    """Condenses the audio streams with the periods of the subtitle at srt_path and returns the period stats"""
     time_start = timer()
+    audio_indices = [audio_index] + list(extra_audio_indices)
+    in_container = multi_track_output == "container" and len(audio_indices) > 1
+    if in_container and output_format not in multi_stream_formats:
+        raise ValueError(
+            f"output_format = {output_format} cannot hold multiple audio streams, must be one of {multi_stream_formats}"
+        )
 
-    periods = extract_periods(srt_path)
-    out_paths = extract_audio_parts(periods, temp_dir, filename, audio_index)
-    concatenate_audio_parts(periods, temp_dir, out_paths, output_filename)
+    if total_duration is None:
+        total_duration = probe_duration(filename)
+    periods = clip_periods(extract_periods(srt_path), total_duration)
+    stats = period_stats(periods, total_duration)
+    print_period_report(stats)
+    if dry_run or plan_only:
+        print("Dry run, skipping extraction")
+        return stats
+    out_paths, loudness = extract_audio_parts(periods, temp_dir, filename, audio_indices)
+    if in_container or len(audio_indices) == 1:
+        concatenate_audio_parts(periods, temp_dir, out_paths, output_filename, loudness)
+    else:
+        for track, track_audio_index in enumerate(audio_indices):
+            track_filename = output_filename if track == 0 else track_output_path(output_filename, track_audio_index)
+            concatenate_audio_parts(periods, temp_dir, [out_paths[track]], track_filename, [loudness[track]])
+
+    output_root = op.splitext(output_filename)[0]
+    if output_timeline_map:
+        write_timeline_map(periods, output_root + ".timeline.json")
+    subtitles = [(path, output_root + suffix + ".srt") for path, suffix in extra_srts]
     if output_condensed_subtitles:
-        condensed_srt_path = op.splitext(output_filename)[0] + ".srt"
-        condense_subtitles(periods, srt_path, condensed_srt_path)
+        subtitles.insert(0, (srt_path, output_root + ".srt"))
+    for original_srt_path, condensed_srt_path in subtitles:
+        condense_subtitles(periods, original_srt_path, condensed_srt_path)
+        condensed_srt_paths = [condensed_srt_path]
+        if segment_duration > 0:
+            condensed_srt_paths = split_subtitles(condensed_srt_path, segment_cuts(periods))
         if condensed_subtitles_format == "lrc":
-            srt_file_to_lrc(condensed_srt_path)
-            os.remove(condensed_srt_path)
+            for path in condensed_srt_paths:
+                srt_file_to_lrc(path)
+                os.remove(path)
 
     time_end = timer()
+    record_benchmark(stats, time_end - time_start)
     print("Finished in {:.2f} seconds".format(time_end - time_start))
+    return stats
+
+
+def timeline_from_periods(periods: List[List[int]]) -> List[List[int]]:
+    """Returns [condensed_start, source_start, duration] in milliseconds for each period"""
+    timeline = []
+    offset = 0
+    for start, end in periods:
+        timeline.append([offset, start, end - start])
+        offset += end - start
+    return timeline
+
+
+def write_timeline_map(periods: List[List[int]], path: str):
+    with open(path, "w", encoding="utf8") as f:
+        json.dump({"version": 1, "periods": timeline_from_periods(periods)}, f, separators=(",", ":"))
+
+
+def load_timeline_map(path: str) -> List[List[int]]:
+    with open(path, "r", encoding="utf8") as f:
+        return json.load(f)["periods"]
+
+
+def condensed_to_source(timeline: List[List[int]], condensed_time: int) -> int:
+    """Maps a time in the condensed audio to the time in the source, both in milliseconds"""
+    if not timeline:
+        return condensed_time
+    i = max(bisect.bisect_right(timeline, condensed_time, key=lambda p: p[0]) - 1, 0)
+    condensed_start, source_start, duration = timeline[i]
+    return source_start + min(max(condensed_time - condensed_start, 0), duration)
+
+
+def source_to_condensed(timeline: List[List[int]], source_time: int) -> int:
+    """Maps a source time to the condensed time, cut out times map to the next period"""
+    if not timeline:
+        return source_time
+    i = bisect.bisect_right(timeline, source_time, key=lambda p: p[1]) - 1
+    if i < 0:
+        return 0
+    condensed_start, source_start, duration = timeline[i]
+    if source_time < source_start + duration:
+        return condensed_start + source_time - source_start
+    return condensed_start + duration
 
 
 def condense_subtitles(periods: List[List[int]], original_srt_path: str, condensed_srt_path: str):
+    import pysrt
+
     subs = pysrt.open(original_srt_path)
     condensed_subs = pysrt.SubRipFile()
-    offset = 0  # Initialize an offset to track the condensed time
-
-    for period_start, period_end in periods:
-        for sub in subs:
-            sub_start = sub.start.ordinal
-            sub_end = sub.end.ordinal
-            if sub_start >= period_start and sub_end <= period_end:
-                # Adjust the subtitle's start and end times
-                sub.start = pysrt.srttime.SubRipTime(milliseconds=sub_start - period_start + offset)
-                sub.end = pysrt.srttime.SubRipTime(milliseconds=sub_end - period_start + offset)
-                condensed_subs.append(sub)
-
-        # Update the offset based on the condensed timeline
-        period_duration = period_end - period_start
-        offset += period_duration
+    timeline = timeline_from_periods(periods)
+    period_starts = [start for start, _ in periods]
+
+    # Find the period that contains each subtitle, keeping the file order within a period
+    contained_subs = []
+    for sub in subs:
+        i = bisect.bisect_right(period_starts, sub.start.ordinal) - 1
+        if i >= 0 and sub.end.ordinal <= periods[i][1]:
+            contained_subs.append((i, sub))
+    contained_subs.sort(key=lambda s: s[0])
+
+    for i, sub in contained_subs:
+        # Adjust the subtitle's start and end times to the condensed timeline
+        offset, period_start, _ = timeline[i]
+        sub_start = sub.start.ordinal
+        sub_end = sub.end.ordinal
+        sub.start = pysrt.srttime.SubRipTime(milliseconds=sub_start - period_start + offset)
+        sub.end = pysrt.srttime.SubRipTime(milliseconds=sub_end - period_start + offset)
+        condensed_subs.append(sub)
 
     condensed_subs.save(condensed_srt_path, encoding="utf-8")
 
 
+def split_subtitles(srt_path: str, cuts: List[int]) -> List[str]:
+    """Splits condensed subtitles to match the segments starting at cuts, and removes the unsplit file"""
+    import pysrt
+
+    subs = pysrt.open(srt_path)
+    bounds = [0] + cuts + [float("inf")]
+    paths = []
+    for i in range(len(bounds) - 1):
+        segment_subs = pysrt.SubRipFile()
+        for sub in subs:
+            if bounds[i] <= sub.start.ordinal < bounds[i + 1]:
+                segment_sub = pysrt.SubRipItem(
+                    len(segment_subs) + 1,
+                    start=pysrt.SubRipTime(milliseconds=sub.start.ordinal - bounds[i]),
+                    end=pysrt.SubRipTime(milliseconds=sub.end.ordinal - bounds[i]),
+                    text=sub.text,
+                )
+                segment_subs.append(segment_sub)
+        path = segment_path(srt_path, i)
+        segment_subs.save(path, encoding="utf-8")
+        paths.append(path)
+    os.remove(srt_path)
+    return paths
+
+
 def srt_file_to_lrc(filename):
     def srt_block_to_lrc(block):
         srt_block_regex = re.compile(
@@ -382,6 +1276,16 @@ def srt_file_to_lrc(filename):
             file_out.write(str_out)
 
 
+def folder_output_dir(parent_folder: str, folder_name: str) -> str:
+    if fixed_output_dir is not None:
+        if fixed_output_dir_with_subfolders:
+            # Create sub-folder within fixed_output_dir
+            return op.join(fixed_output_dir, folder_name + "_con")
+        # Output directly to fixed_output_dir
+        return fixed_output_dir
+    return op.join(parent_folder, folder_name + "_con")
+
+
 def condense_multi(
     subtitle_option: List[str],
     video_paths: List[str],
@@ -390,8 +1294,12 @@ def condense_multi(
     audio_stream: List[dict],
     parent_folder: str,
     folder_name: str,
-    temp_dir: str,
-):
+    plan_only: bool = False,
+    interactive: bool = True,
+    durations: Optional[List[Optional[int]]] = None,
+) -> List[dict]:
+    """Condenses the videos into the folder's "_con" output folder, or returns their plan entries"""
+    plan = []
     all_subtitle_paths, invalid_videos = find_matching_subtitles_for_files(video_paths)
     sub_index = 0
     if invalid_videos:
@@ -403,21 +1311,20 @@ def condense_multi(
             )
         is_all_none = all(s is None for s in all_subtitle_paths)
         file_name_str = "all files" if is_all_none else "some files"
-        sub_index = choose_subtitle_stream(subtitle_stream, file_name_str)
-
-    message = "These files have multiple audio streams. Which one would you like to use?"
-    audio_index = choose_audio_stream(audio_stream, message)
-
-    if fixed_output_dir is not None:
-        if fixed_output_dir_with_subfolders:
-            # Create sub-folder within fixed_output_dir
-            output_dir: str = op.join(fixed_output_dir, folder_name + "_con")
+        if interactive:
+            sub_index = choose_subtitle_stream(subtitle_stream, file_name_str)
         else:
-            # Output directly to fixed_output_dir
-            output_dir: str = fixed_output_dir
+            sub_index = configured_stream_index(default_subtitle_stream, subtitle_stream)
+
+    if interactive:
+        message = "These files have multiple audio streams. Which one would you like to use?"
+        audio_index = choose_audio_stream(audio_stream, message)
     else:
-        output_dir: str = op.join(parent_folder, folder_name + "_con")
-    os.makedirs(output_dir, exist_ok=True)
+        audio_index = configured_stream_index(default_audio_stream, audio_stream)
+
+    output_dir = folder_output_dir(parent_folder, folder_name)
+    if not plan_only:
+        os.makedirs(output_dir, exist_ok=True)
     all_time_start = timer()
 
     for i in range(len(video_paths)):
@@ -425,93 +1332,476 @@ def condense_multi(
         v_root = op.splitext(video_names[i])[0]
         output_filename = v_root + "." + output_format
         output_filepath = op.join(output_dir, output_filename)
-        if op.isfile(output_filepath):
+        if op.isfile(output_filepath) or (segment_duration > 0 and op.isfile(segment_path(output_filepath, 0))):
             print("{} already exists. Skipping".format(output_filename))
             continue
 
         print("Condensing video " + str(i + 1))
-        os.makedirs(temp_dir, exist_ok=True)
-        if all_subtitle_paths and all_subtitle_paths[i]:
-            srt_path = convert_sub_if_needed(all_subtitle_paths[i], temp_dir)
-        else:
-            srt_path = extract_srt(temp_dir, v_path, sub_index)
-        condense(srt_path, temp_dir, v_path, audio_index, output_filepath)
-
-        shutil.rmtree(temp_dir, ignore_errors=True)
+        total_duration = durations[i] if durations is not None else probe_duration(v_path)
+        with workspace(estimate_workspace_size(total_duration, audio_stream), not plan_only) as temp_dir:
+            sub_path = all_subtitle_paths[i] if all_subtitle_paths else None
+            if sub_path:
+                srt_path = convert_sub_if_needed(sub_path, temp_dir)
+            else:
+                codec_name = subtitle_stream[sub_index].get("codec_name", "") if subtitle_stream else ""
+                srt_path = extract_srt(temp_dir, v_path, sub_index, codec_name)
+            extra_srts = [] if plan_only else get_extra_srts(v_path, subtitle_stream, temp_dir)
+            extra_audio_indices = get_extra_audio_indices(audio_index, audio_stream)
+            stats = condense(
+                srt_path,
+                temp_dir,
+                v_path,
+                audio_index,
+                output_filepath,
+                total_duration,
+                extra_audio_indices,
+                extra_srts,
+                plan_only,
+            )
+        if plan_only:
+            plan.append(make_plan_entry(v_path, output_filepath, audio_index, sub_path, sub_index, stats))
 
     all_time_end = timer()
     print("Finished {} files in {:.2f} seconds".format(len(video_paths), all_time_end - all_time_start))
+    return plan
+
+
+def scan_watch_folder(folder: str) -> dict:
+    """Returns the size and modification time of each video and its subtitle in the folder"""
+    signatures = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.is_file() or op.splitext(entry.name)[1] not in video_exts:
+                continue
+            try:
+                video_stat = entry.stat()
+                sub_path = find_subtitle_with_same_name_as_file(entry.path)
+                sub_stat = os.stat(sub_path) if sub_path else None
+            except OSError:
+                # Removed while scanning
+                continue
+            signature = (video_stat.st_size, video_stat.st_mtime_ns, sub_path)
+            if sub_stat is not None:
+                signature += (sub_stat.st_size, sub_stat.st_mtime_ns)
+            signatures[entry.path] = signature
+    return signatures
+
+
+def newest_signature_mtime(signature: tuple) -> int:
+    """Returns the later modification time of the video and its subtitle, in nanoseconds"""
+    if len(signature) > 3:
+        return max(signature[1], signature[4])
+    return signature[1]
+
+
+def settled_videos(signatures: dict, seen: dict, now: float) -> Tuple[List[str], Optional[float]]:
+    """Returns the unhandled videos that have not changed for watch_settle_time, and the next wait"""
+    for path in list(seen):
+        if path not in signatures:
+            del seen[path]
+    for path, signature in signatures.items():
+        if path not in seen:
+            # Files that were already there when first seen do not need to wait again
+            newest_mtime = newest_signature_mtime(signature) / 1e9
+            seen[path] = [signature, min(now, newest_mtime), False]
+        elif seen[path][0] != signature:
+            seen[path] = [signature, now, False]
+
+    ready = []
+    next_wait = None
+    for path, (_, changed_at, handled) in sorted(seen.items()):
+        if handled:
+            continue
+        wait = changed_at + watch_settle_time - now
+        if wait <= 0:
+            ready.append(path)
+        elif next_wait is None or wait < next_wait:
+            next_wait = wait
+    return ready, next_wait
+
+
+def is_output_up_to_date(output_path: str, signature: tuple) -> bool:
+    """Checks that the output exists and was written after the last change of the video and its subtitle"""
+    if segment_duration > 0 and not op.isfile(output_path):
+        output_path = segment_path(output_path, 0)
+    if not op.isfile(output_path):
+        return False
+    newest_mtime = newest_signature_mtime(signature)
+    return os.stat(output_path).st_mtime_ns >= newest_mtime
+
+
+def open_inotify(folder: str) -> Optional[int]:
+    """Returns an inotify file descriptor watching the folder, or None where inotify is not available"""
+    if not sys.platform.startswith("linux"):
+        return None
+    import ctypes
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(folder), inotify_mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def wait_for_changes(inotify_fd: Optional[int], timeout: Optional[float]):
+    """Blocks until something changes in the watched folder or the timeout passes"""
+    if inotify_fd is None:
+        time.sleep(watch_poll_interval if timeout is None else min(timeout, watch_poll_interval))
+        return
+    import select
+
+    readable, _, _ = select.select([inotify_fd], [], [], timeout)
+    while readable:
+        # The events are only used as a wake-up, the folder is scanned again afterwards
+        os.read(inotify_fd, 65536)
+        readable, _, _ = select.select([inotify_fd], [], [], 0)
+
+
+def output_set_pattern(root: str) -> re.Pattern:
+    variants = [r"_track\d+", r"_sub\d+"] + [re.escape(suffix) for suffix in extra_sub_suffixes]
+    extensions = [re.escape(output_format), "srt", "lrc", "m3u8", r"timeline\.json"]
+    return re.compile(
+        r"{}(?:{})?(?:_\d{{3}})?\.(?:{})".format(re.escape(root), "|".join(variants), "|".join(extensions))
+    )
+
+
+def output_set_paths(output_path: str, other_roots: Sequence[str] = ()) -> List[str]:
+    """Returns the existing files of an output, except those named like the outputs of other_roots"""
+    output_dir, output_name = op.split(output_path)
+    if not op.isdir(output_dir):
+        return []
+    pattern = output_set_pattern(op.splitext(output_name)[0])
+    other_patterns = [output_set_pattern(other_root) for other_root in other_roots]
+    return [
+        op.join(output_dir, f)
+        for f in sorted(os.listdir(output_dir))
+        if pattern.fullmatch(f) and not any(p.fullmatch(f) for p in other_patterns)
+    ]
+
+
+def configured_stream_index(index: int, streams: List[dict]) -> int:
+    return index if 0 <= index < len(streams) else 0
+
+
+def condense_watched_video(video_path: str, signature: tuple, parent_folder: str, folder_name: str):
+    output_dir = folder_output_dir(parent_folder, folder_name)
+    video_name = op.basename(video_path)
+    output_path = op.join(output_dir, op.splitext(video_name)[0] + "." + output_format)
+    if is_output_up_to_date(output_path, signature):
+        return
+    # The video or its subtitle changed after the output was written. The whole set is removed, since the new one can
+    # have fewer segments or tracks
+    video_folder = op.dirname(video_path)
+    other_roots = [
+        op.splitext(f)[0] for f in os.listdir(video_folder) if op.splitext(f)[1] in video_exts and f != video_name
+    ]
+    for stale_path in output_set_paths(output_path, other_roots):
+        os.remove(stale_path)
+
+    print("Condensing new video:", video_path)
+    audio_streams, subtitle_streams, total_duration = probe_video(video_path)
+    condense_multi(
+        streams_to_options(subtitle_streams),
+        [video_path],
+        [video_name],
+        subtitle_streams,
+        audio_streams,
+        parent_folder,
+        folder_name,
+        interactive=False,
+        durations=[total_duration],
+    )
+
+
+def watch_folder(folder: str):
+    """Condenses the videos in the folder as they arrive or change, until interrupted"""
+    folder = op.abspath(folder)
+    parent_folder, folder_name = op.split(folder)
+    inotify_fd = open_inotify(folder) if watch_use_inotify else None
+    print("Watching folder{}: {}".format(" with inotify" if inotify_fd is not None else "", folder))
+    seen = {}
+    try:
+        while True:
+            ready, next_wait = settled_videos(scan_watch_folder(folder), seen, time.time())
+            for video_path in ready:
+                signature = seen[video_path][0]
+                try:
+                    condense_watched_video(video_path, signature, parent_folder, folder_name)
+                except Exception as ex:
+                    # A failed video is tried again only after it changes
+                    log_error(video_path, ex)
+                seen[video_path][2] = True
+            if ready:
+                # Condensing takes a while, so the folder is scanned again right away
+                continue
+            wait_for_changes(inotify_fd, next_wait)
+    finally:
+        if inotify_fd is not None:
+            os.close(inotify_fd)
+
+
+def log_error(file_path: Optional[str], ex: Exception):
+    print("{}: {}".format(type(ex).__name__, ex))
+    import traceback
+
+    print(traceback.format_exc())
+    time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    heading = f"{time_str} - {file_path}"
+    message = f"{heading}\n{'-' * len(heading)}\n{ex}\n{traceback.format_exc()}\n\n"
+    with open(op.join(get_application_path(), "log.txt"), "a") as f:
+        f.write(message)
 
 
-def main(file_path: Optional[str] = None):
-    temp_dir = None
+def get_application_path() -> str:
     if getattr(sys, "frozen", False):
-        application_path = op.dirname(op.abspath(sys.executable))
-    else:
-        application_path = op.dirname(op.abspath(__file__))
+        return op.dirname(op.abspath(sys.executable))
+    return op.dirname(op.abspath(__file__))
+
+
+def single_output_path(file_path: str, output_dir: Optional[str] = None) -> str:
+    file_root, _ = op.splitext(file_path)
+    if output_dir is None:
+        output_dir = fixed_output_dir
+    if output_dir is not None:
+        file_root = op.join(output_dir, op.splitext(op.basename(file_path))[0])
+    return file_root + "_con." + output_format
+
+
+def load_config(application_path: str):
+    """Sets the globals from the config.json next to the application"""
+    config_path = op.join(application_path, "config.json")
+    if op.isfile(config_path):
+        with open(config_path, "r", encoding="utf8") as f:
+            conf = json.load(f)
+            if "padding" in conf:
+                global padding
+                padding = conf.get("padding")
+                if padding < 0:
+                    padding = 0
+                if padding > 60000:
+                    padding = 60000
+            if "min_gap_to_bridge" in conf:
+                global min_gap_to_bridge
+                min_gap_to_bridge = max(conf.get("min_gap_to_bridge"), 0)
+            if "max_period_length" in conf:
+                global max_period_length
+                max_period_length = max(conf.get("max_period_length"), 0)
+            if "min_period_duration" in conf:
+                global min_period_duration
+                min_period_duration = max(conf.get("min_period_duration"), 0)
+            if "dry_run" in conf:
+                global dry_run
+                dry_run = conf.get("dry_run")
+            if "ask_when_multiple_srt" in conf:
+                global mulsrt_ask
+                mulsrt_ask = conf.get("ask_when_multiple_srt")
+            if "filtered_characters" in conf:
+                global filtered_chars
+                filtered_chars = conf.get("filtered_characters")
+            if "filter_parentheses" in conf:
+                global filter_parentheses
+                filter_parentheses = conf.get("filter_parentheses")
+            if "output_format" in conf:
+                global output_format
+                output_format = conf.get("output_format")
+            if "sub_suffix" in conf:
+                global sub_suffix
+                sub_suffix = conf.get("sub_suffix")
+            if "fixed_output_dir" in conf:
+                global fixed_output_dir
+                fixed_output_dir = conf.get("fixed_output_dir")
+            if "fixed_output_dir_with_subfolders" in conf:
+                global fixed_output_dir_with_subfolders
+                fixed_output_dir_with_subfolders = conf.get("fixed_output_dir_with_subfolders")
+            if "scratch_dir" in conf:
+                global scratch_dir
+                scratch_dir = conf.get("scratch_dir")
+            if "use_ram_disk" in conf:
+                global use_ram_disk
+                use_ram_disk = conf.get("use_ram_disk")
+            if "temp_budget_mb" in conf:
+                global temp_budget_mb
+                temp_budget_mb = max(conf.get("temp_budget_mb"), 0)
+            if "watch_settle_time" in conf:
+                global watch_settle_time
+                watch_settle_time = max(conf.get("watch_settle_time"), 0)
+            if "watch_poll_interval" in conf:
+                global watch_poll_interval
+                watch_poll_interval = max(conf.get("watch_poll_interval"), 1)
+            if "watch_use_inotify" in conf:
+                global watch_use_inotify
+                watch_use_inotify = conf.get("watch_use_inotify")
+            if "default_audio_stream" in conf:
+                global default_audio_stream
+                default_audio_stream = conf.get("default_audio_stream")
+            if "default_subtitle_stream" in conf:
+                global default_subtitle_stream
+                default_subtitle_stream = conf.get("default_subtitle_stream")
+            if "use_system_ffmpeg" in conf:
+                global use_system_ffmpeg
+                use_system_ffmpeg = conf.get("use_system_ffmpeg")
+            if "audio_channels" in conf:
+                global audio_channels
+                audio_channels = conf.get("audio_channels") or 0
+                if audio_channels and audio_channels not in channel_layouts:
+                    raise ValueError(f"audio_channels = {audio_channels} is not supported, must be 1 or 2")
+            if "audio_sample_rate" in conf:
+                global audio_sample_rate
+                audio_sample_rate = conf.get("audio_sample_rate") or 0
+            if "boundary_fade" in conf:
+                global boundary_fade
+                boundary_fade = max(conf.get("boundary_fade"), 0)
+            if "loudnorm" in conf:
+                global loudnorm
+                loudnorm = conf.get("loudnorm")
+            if "loudnorm_target" in conf:
+                global loudnorm_target
+                loudnorm_target = conf.get("loudnorm_target")
+            if "segment_duration" in conf:
+                global segment_duration
+                segment_duration = max(conf.get("segment_duration"), 0)
+            if "segment_playlist" in conf:
+                global segment_playlist
+                segment_playlist = conf.get("segment_playlist")
+            if "output_chapters" in conf:
+                global output_chapters
+                output_chapters = conf.get("output_chapters")
+            if "extra_audio_streams" in conf:
+                global extra_audio_streams
+                extra_audio_streams = conf.get("extra_audio_streams")
+            if "extra_subtitle_streams" in conf:
+                global extra_subtitle_streams
+                extra_subtitle_streams = conf.get("extra_subtitle_streams")
+            if "extra_sub_suffixes" in conf:
+                global extra_sub_suffixes
+                extra_sub_suffixes = conf.get("extra_sub_suffixes")
+            if "multi_track_output" in conf:
+                global multi_track_output
+                multi_track_output = conf.get("multi_track_output")
+                supported_modes = ["separate", "container"]
+                if multi_track_output not in supported_modes:
+                    msg = f"multi_track_output = {multi_track_output} is not supported"
+                    msg += f", must be one of {supported_modes}"
+                    raise ValueError(msg)
+            if "encode_profiles" in conf:
+                global encode_profiles
+                encode_profiles = conf.get("encode_profiles")
+            if "encode_profile" in conf:
+                global encode_profile
+                encode_profile = conf.get("encode_profile")
+            if "output_timeline_map" in conf:
+                global output_timeline_map
+                output_timeline_map = conf.get("output_timeline_map")
+            if "output_condensed_subtitles" in conf:
+                global output_condensed_subtitles
+                output_condensed_subtitles = conf.get("output_condensed_subtitles")
+            if "condensed_subtitles_format" in conf:
+                global condensed_subtitles_format
+                condensed_subtitles_format = conf.get("condensed_subtitles_format")
+                supported_formats = ["srt", "lrc"]
+                if condensed_subtitles_format not in supported_formats:
+                    msg = f"condensed_subtitles_format = {condensed_subtitles_format} is not supported"
+                    f", must be one of {supported_formats}"
+                    raise ValueError(msg)
+
+    global benchmark_path
+    global cache_dir
+    benchmark_path = op.join(application_path, "benchmarks.json")
+    cache_dir = op.join(application_path, "cache")
+
+
+def setup_binaries():
+    global ffmpeg_cmd
+    global ffprobe_cmd
+    ffmpeg_cmd, ffprobe_cmd = resolve_ffmpeg(use_system_ffmpeg)
+    check_binary(ffmpeg_cmd)
+    check_binary(ffprobe_cmd)
+
+
+def benchmark_encode_profiles(file_path: str) -> List[dict]:
+    """Condenses a file once with each encode profile in config.json and reports the speed and output size of each"""
+    global encode_profile
+    load_config(get_application_path())
+    setup_binaries()
+
+    audio_streams, subtitle_streams, total_duration = probe_video(file_path)
+    audio_index = choose_audio_stream(
+        audio_streams, "This file has multiple audio streams. Which one would you like to use?"
+    )
+    extra_audio_indices = get_extra_audio_indices(audio_index, audio_streams)
+    configured_profile = encode_profile
+    results = []
+    with workspace(estimate_workspace_size(total_duration, audio_streams)) as temp_dir:
+        srt_path, _, _ = get_srt(subtitle_streams, op.dirname(file_path), file_path, temp_dir)
+        # Outputs go to a temporary folder, so existing outputs are never touched
+        output_dir = tempfile.mkdtemp(prefix="condenser_benchmark-")
+        try:
+            # The first run is not timed, so that no profile pays for reading the video into the disk cache
+            for i, name in enumerate([configured_profile] + list(encode_profiles)):
+                if i > 0:
+                    print("Benchmarking encode profile", name)
+                encode_profile = name
+                # Each run gets its own folders, so the parts and outputs of the previous run are not in the way
+                run_temp_dir = op.join(temp_dir, str(i))
+                run_output_dir = op.join(output_dir, str(i))
+                os.makedirs(run_temp_dir)
+                os.makedirs(run_output_dir)
+                output_filename = single_output_path(file_path, run_output_dir)
+                time_start = timer()
+                condense(
+                    srt_path, run_temp_dir, file_path, audio_index, output_filename, total_duration, extra_audio_indices
+                )
+                elapsed = timer() - time_start
+                shutil.rmtree(run_temp_dir)
+                if i > 0:
+                    audio_files = [f for f in os.listdir(run_output_dir) if f.endswith("." + output_format)]
+                    output_size = (
+                        sum(op.getsize(op.join(run_output_dir, f)) for f in audio_files) if audio_files else None
+                    )
+                    results.append({"profile": name, "elapsed": elapsed, "output_size": output_size})
+        finally:
+            encode_profile = configured_profile
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    print("{:<12}{:>12}{:>12}{:>16}".format("Profile", "Seconds", "Speed", "Size (KB)"))
+    for result in results:
+        speed = "{:.1f}x".format(total_duration / 1000 / result["elapsed"]) if total_duration else "-"
+        size = "{:.0f}".format(result["output_size"] / 1024) if result["output_size"] is not None else "-"
+        print("{:<12}{:>12.2f}{:>12}{:>16}".format(result["profile"], result["elapsed"], speed, size))
+    return results
+
+
+def main(
+    file_path: Optional[str] = None,
+    plan_path: Optional[str] = None,
+    profile: Optional[str] = None,
+    watch: bool = False,
+):
+    """Condenses a video or a folder of videos, or writes a plan of them to plan_path"""
+    global encode_profile
+    plan = []
+    application_path = get_application_path()
 
     try:
-        # Load config
-        config_path = op.join(application_path, "config.json")
-        if op.isfile(config_path):
-            with open(config_path, "r", encoding="utf8") as f:
-                conf = json.load(f)
-                if "padding" in conf:
-                    global padding
-                    padding = conf.get("padding")
-                    if padding < 0:
-                        padding = 0
-                    if padding > 60000:
-                        padding = 60000
-                if "ask_when_multiple_srt" in conf:
-                    global mulsrt_ask
-                    mulsrt_ask = conf.get("ask_when_multiple_srt")
-                if "filtered_characters" in conf:
-                    global filtered_chars
-                    filtered_chars = conf.get("filtered_characters")
-                if "filter_parentheses" in conf:
-                    global filter_parentheses
-                    filter_parentheses = conf.get("filter_parentheses")
-                if "output_format" in conf:
-                    global output_format
-                    output_format = conf.get("output_format")
-                if "sub_suffix" in conf:
-                    global sub_suffix
-                    sub_suffix = conf.get("sub_suffix")
-                if "fixed_output_dir" in conf:
-                    global fixed_output_dir
-                    fixed_output_dir = conf.get("fixed_output_dir")
-                if "fixed_output_dir_with_subfolders" in conf:
-                    global fixed_output_dir_with_subfolders
-                    fixed_output_dir_with_subfolders = conf.get("fixed_output_dir_with_subfolders")
-                if "use_system_ffmpeg" in conf:
-                    global ffmpeg_cmd
-                    global ffprobe_cmd
-                    if conf.get("use_system_ffmpeg"):
-                        ffmpeg_cmd = "ffmpeg"
-                        ffprobe_cmd = "ffprobe"
-                    else:
-                        try:
-                            sp.call([ffmpeg_cmd], stdout=sp.DEVNULL, stderr=sp.DEVNULL)
-                            sp.call([ffprobe_cmd], stdout=sp.DEVNULL, stderr=sp.DEVNULL)
-                        except FileNotFoundError:
-                            print("ffmpeg or ffprobe not found in the utils/ffmpeg folder. Will try system ffmpeg")
-                            ffmpeg_cmd = "ffmpeg"
-                            ffprobe_cmd = "ffprobe"
-                if "output_condensed_subtitles" in conf:
-                    global output_condensed_subtitles
-                    output_condensed_subtitles = conf.get("output_condensed_subtitles")
-                if "condensed_subtitles_format" in conf:
-                    global condensed_subtitles_format
-                    condensed_subtitles_format = conf.get("condensed_subtitles_format")
-                    supported_formats = ["srt", "lrc"]
-                    if condensed_subtitles_format not in supported_formats:
-                        msg = f"condensed_subtitles_format = {condensed_subtitles_format} is not supported"
-                        f", must be one of {supported_formats}"
-                        raise ValueError(msg)
+        load_config(application_path)
+        plan_only = plan_path is not None
+        if profile is not None:
+            encode_profile = profile
+        if encode_profile is not None and encode_profile not in encode_profiles:
+            raise ValueError(f"encode_profile = {encode_profile} is not one of {list(encode_profiles)}")
+
+        cleanup_orphaned_workspaces()
 
         # Get video file
         if file_path is None:
+            import easygui as g
+
             msg = (
                 "Would you like to condense one video or a folder of videos?\n"
                 + "(You can also drag and drop videos or folders directly to the executable or its shortcut)"
@@ -529,11 +1819,16 @@ def main(file_path: Optional[str] = None):
         if not op.exists(file_path):
             raise OSError("No such file or directory: " + file_path)
 
-        if op.isdir(file_path):
+        setup_binaries()
+
+        if watch:
+            if not op.isdir(file_path):
+                raise ValueError("Watch mode needs a folder: " + file_path)
+            watch_folder(file_path)
+        elif op.isdir(file_path):
             print("Checking videos in folder:", file_path)
 
             parent_folder, folder_name = op.split(file_path)
-            temp_dir = op.join(tempfile.gettempdir(), "condenser_temp-{}".format(int(time.time() * 1000)))
 
             file_names = [f for f in os.listdir(file_path) if op.isfile(op.join(file_path, f))]
             video_names = [f for f in file_names if op.splitext(f)[1] in video_exts]
@@ -541,12 +1836,12 @@ def main(file_path: Optional[str] = None):
             print("Found {} videos out of {} files".format(len(video_names), len(file_names)))
             video_paths = [op.join(file_path, f) for f in video_names]
             all_streams = [probe_video(v) for v in video_paths]
-            all_audio_streams, all_subtitle_streams = map(list, zip(*all_streams, strict=True))
+            all_audio_streams, all_subtitle_streams, all_durations = map(list, zip(*all_streams, strict=True))
             all_audio_options = list(map(streams_to_options, all_audio_streams))
             all_subtitle_options = list(map(streams_to_options, all_subtitle_streams))
             if check_all_equal(all_audio_options) and check_all_equal(all_subtitle_options):
                 print("Streams are consistent")
-                condense_multi(
+                plan += condense_multi(
                     all_subtitle_options[0],
                     video_paths,
                     video_names,
@@ -554,7 +1849,9 @@ def main(file_path: Optional[str] = None):
                     all_audio_streams[0],
                     parent_folder,
                     folder_name,
-                    temp_dir,
+                    plan_only,
+                    interactive=not plan_only,
+                    durations=all_durations,
                 )
             else:
                 all_options = list(zip(all_audio_options, all_subtitle_options, strict=True))
@@ -576,45 +1873,68 @@ def main(file_path: Optional[str] = None):
                     vns = [video_names[i] for i in ids]
                     s_s = all_subtitle_streams[ids[0]]
                     a_s = all_audio_streams[ids[0]]
-                    condense_multi(so, vps, vns, s_s, a_s, parent_folder, folder_name, temp_dir)
+                    durations = [all_durations[i] for i in ids]
+                    plan += condense_multi(
+                        so, vps, vns, s_s, a_s, parent_folder, folder_name, plan_only, not plan_only, durations
+                    )
         else:
             print("Opening video:", file_path)
 
-            file_root, _ = op.splitext(file_path)
-            file_folder, file_name = op.split(file_path)
-            temp_dir = op.join(tempfile.gettempdir(), ".temp-{}".format(int(time.time() * 1000)))
+            file_folder, _ = op.split(file_path)
 
-            audio_streams, subtitle_streams = probe_video(file_path)
-            os.makedirs(temp_dir)
-            srt_path = get_srt(subtitle_streams, file_folder, file_path, temp_dir)
-            audio_index = choose_audio_stream(
-                audio_streams, "This file has multiple audio streams. Which one would you like to use?"
-            )
+            audio_streams, subtitle_streams, total_duration = probe_video(file_path)
+            # Planning runs unattended, so nothing is asked, waited for or created
+            with workspace(estimate_workspace_size(total_duration, audio_streams), not plan_only) as temp_dir:
+                srt_path, sub_path, sub_index = get_srt(
+                    subtitle_streams, file_folder, file_path, temp_dir, not plan_only
+                )
+                if plan_only:
+                    audio_index = configured_stream_index(default_audio_stream, audio_streams)
+                else:
+                    audio_index = choose_audio_stream(
+                        audio_streams, "This file has multiple audio streams. Which one would you like to use?"
+                    )
+
+                output_filename = single_output_path(file_path)
+                extra_srts = []
+                if not plan_only:
+                    os.makedirs(op.dirname(op.abspath(output_filename)), exist_ok=True)
+                    extra_srts = get_extra_srts(file_path, subtitle_streams, temp_dir)
+                extra_audio_indices = get_extra_audio_indices(audio_index, audio_streams)
+                stats = condense(
+                    srt_path,
+                    temp_dir,
+                    file_path,
+                    audio_index,
+                    output_filename,
+                    total_duration,
+                    extra_audio_indices,
+                    extra_srts,
+                    plan_only,
+                )
+            if plan_only:
+                plan.append(make_plan_entry(file_path, output_filename, audio_index, sub_path, sub_index, stats))
 
-            if fixed_output_dir is not None:
-                os.makedirs(fixed_output_dir, exist_ok=True)
-                file_name_root, _ = op.splitext(file_name)
-                file_root = op.join(fixed_output_dir, file_name_root)
-            condense(srt_path, temp_dir, file_path, audio_index, file_root + "_con." + output_format)
+        if plan_only:
+            write_plan(plan, plan_path)
 
     except Exception as ex:
-        print("{}: {}".format(type(ex).__name__, ex))
-        import traceback
-
-        print(traceback.format_exc())
-        time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        heading = f"{time_str} - {file_path}"
-        message = f"{heading}\n{'-' * len(heading)}\n{ex}\n{traceback.format_exc()}\n\n"
-        with open(op.join(application_path, "log.txt"), "a") as f:
-            f.write(message)
-
-    finally:
-        if temp_dir is not None:
-            shutil.rmtree(temp_dir, ignore_errors=True)
+        log_error(file_path, ex)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 1:
-        main()
+    parser = argparse.ArgumentParser(description="Extracts speech audio from videos based on subtitle timings")
+    parser.add_argument("file_path", nargs="?", help="video file or folder of videos to condense")
+    parser.add_argument("--plan", metavar="PLAN_PATH", help="write a JSON cost plan here instead of condensing")
+    parser.add_argument("--profile", help="encode profile from config.json to use")
+    parser.add_argument("--watch", action="store_true", help="keep condensing new videos that arrive in the folder")
+    parser.add_argument(
+        "--benchmark-profiles", action="store_true", help="report the speed and output size of each encode profile"
+    )
+    args = parser.parse_args()
+    if args.benchmark_profiles:
+        if args.file_path is None or not op.isfile(args.file_path):
+            parser.error("--benchmark-profiles needs a video file")
+        benchmark_encode_profiles(args.file_path)
     else:
-        main(sys.argv[1])
+        main(args.file_path, args.plan, args.profile, args.watch)
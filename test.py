@@ -1,11 +1,23 @@
 import inspect
+import array
+import bisect
 import json
+import math
 import os
 import os.path as op
+import random
 import shutil
+import subprocess as sp
+import sys
+import tempfile
+import time
 import unittest
+import wave
 from unittest.mock import patch
 
+import pysrt
+
+import condenser
 from condenser import main
 
 
@@ -37,6 +49,17 @@ def config_set(key, val):
         json.dump(config, f, indent=2)
 
 
+def write_srt(path, cues):
+    """Writes (start_ms, end_ms, text) cues to an srt file"""
+
+    def ts(ms):
+        return "{:02d}:{:02d}:{:02d},{:03d}".format(ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000)
+
+    with open(path, "w", encoding="utf-8") as f:
+        for i, (start, end, text) in enumerate(cues):
+            f.write(f"{i + 1}\n{ts(start)} --> {ts(end)}\n{text}\n\n")
+
+
 def restore_config():
     if op.exists("config.json.bak"):
         with open("config.json", "r", encoding="utf-8") as f:
@@ -48,6 +71,14 @@ def restore_config():
         os.remove("config.json.bak")
 
 
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir, ignore_errors=True)
+
+
 class TestFiles(unittest.TestCase):
     _input_dir = "test_files/inputs"
     _output_dir = "test_files/outputs"
@@ -57,7 +88,7 @@ class TestFiles(unittest.TestCase):
         restore_config()
         if self._delete_outputs:
             for filename in os.listdir(self._input_dir):
-                if "_con." in filename:
+                if "_con." in filename or "_con_" in filename:
                     os.remove(f"{self._input_dir}/{filename}")
 
     def _testFile(self, filename, output_formats=("mp3",), out_test_dir=None):
@@ -70,12 +101,14 @@ class TestFiles(unittest.TestCase):
         for output_format in output_formats:
             self._checkOutput(filename, output_format, out_test_dir)
 
-    def _checkOutput(self, filename, output_format="mp3", out_test_dir=None):
+    def _checkOutput(self, filename, output_format="mp3", out_test_dir=None, segment=None):
         if out_test_dir is None:
             out_test_dir = self._input_dir
-        filename_root = op.splitext(filename)[0]
-        out_test_path = f"{out_test_dir}/{filename_root}_con.{output_format}"
-        out_true_path = f"{self._output_dir}/{filename_root}_con.{output_format}"
+        filename_root = op.splitext(filename)[0] + "_con"
+        if segment is not None:
+            filename_root += f"_{segment:03d}"
+        out_test_path = f"{out_test_dir}/{filename_root}.{output_format}"
+        out_true_path = f"{self._output_dir}/{filename_root}.{output_format}"
         self.assertTrue(op.exists(out_test_path), f"Output file {out_test_path} does not exist")
         self.assertTrue(op.exists(out_true_path), f"Output file {out_true_path} does not exist")
         self.assertTrue(are_files_similar(out_test_path, out_true_path))
@@ -131,6 +164,55 @@ class TestFiles(unittest.TestCase):
         config_set(("output_condensed_subtitles", "condensed_subtitles_format"), (True, "lrc"))
         self._testFile("1a0s.mkv", ("mp3", "lrc"))
 
+    def testSegmentedOutput(self):
+        config_set(("segment_duration", "segment_playlist", "output_condensed_subtitles"), (20, True, True))
+        self._testFile("1a0s-long.mkv", ("m3u8",))
+        for i in range(3):
+            for output_format in ("mp3", "srt"):
+                self._checkOutput("1a0s-long.mkv", output_format, segment=i)
+        self.assertFalse(op.exists(f"{self._input_dir}/1a0s-long_con_003.mp3"))
+        self.assertFalse(op.exists(f"{self._input_dir}/1a0s-long_con.mp3"))
+
+    def testSingleSegmentOutput(self):
+        config_set("segment_duration", 600)
+        self._testFile("1a0s.mkv", ())
+        self._checkOutput("1a0s.mkv", "mp3", segment=0)
+        self.assertFalse(op.exists(f"{self._input_dir}/1a0s_con_001.mp3"))
+
+    def testChaptersOutput(self):
+        config_set(("output_format", "output_chapters"), ("mka", True))
+        self._testFile("1a1s.mkv", ("mka",))
+        result = sp.run(
+            [condenser.ffprobe_cmd, "-v", "error", "-show_chapters", "-of", "json", f"{self._input_dir}/1a1s_con.mka"],
+            capture_output=True,
+            check=True,
+        )
+        self.assertGreater(len(json.loads(result.stdout)["chapters"]), 1)
+
+    @patch("easygui.indexbox")
+    def testContainerMultiTrackOutput(self, mock_indexbox):
+        mock_indexbox.side_effect = [1, 2]
+        config_set(("output_format", "multi_track_output", "extra_audio_streams"), ("mka", "container", [0]))
+        self._testFile("3a2s.mkv", ("mka",))
+        result = sp.run(
+            [condenser.ffprobe_cmd, "-v", "error", "-show_streams", "-of", "json", f"{self._input_dir}/3a2s_con.mka"],
+            capture_output=True,
+            check=True,
+        )
+        self.assertEqual([s["codec_type"] for s in json.loads(result.stdout)["streams"]], ["audio", "audio"])
+
+    def testLoudnormOutput(self):
+        config_set(("output_format", "loudnorm"), ("m4a", True))
+        self._testFile("1a0s.mkv", ("m4a",))
+        result = sp.run(
+            [condenser.ffmpeg_cmd, "-hide_banner", "-nostats", "-i", f"{self._input_dir}/1a0s_con.m4a"]
+            + ["-af", "ebur128=peak=true", "-f", "null", "-"],
+            capture_output=True,
+            text=True,
+        )
+        loudness = condenser.parse_ebur128_summaries(result.stderr)[-1]
+        self.assertAlmostEqual(loudness["I"], -16, delta=1.5)
+
     @patch("easygui.fileopenbox")
     @patch("easygui.buttonbox")
     def testWithGUISelection(self, mock_buttonbox, mock_fileopenbox):
@@ -312,3 +394,955 @@ class TestErrors(unittest.TestCase):
         self.assertTrue(op.exists("log.txt"))
         log = self.getLog()
         self.assertTrue("Audio stream selection canceled" in log)
+
+
+class TestPeriods(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self._srt_path = op.join(self._temp_dir, "periods.srt")
+
+    def testClipPeriods(self):
+        periods = [[0, 1000], [2000, 4000], [5000, 6000]]
+        self.assertEqual(condenser.clip_periods(periods, 3000), [[0, 1000], [2000, 3000]])
+        self.assertEqual(condenser.clip_periods(periods, None), periods)
+
+    @unittest.skipUnless(shutil.which("ffprobe"), "Needs ffprobe in PATH")
+    def testProbeVideoDuration(self):
+        with patch.object(condenser, "ffprobe_cmd", shutil.which("ffprobe")):
+            with patch.object(condenser.sp, "run", wraps=sp.run) as run:
+                audio_streams, _, duration = condenser.probe_video("test_files/inputs/1a0s.mkv")
+        # The duration comes from the same ffprobe call as the streams
+        self.assertEqual(run.call_count, 1)
+        self.assertEqual(len(audio_streams), 1)
+        self.assertAlmostEqual(duration, 11180, delta=100)
+
+    def _periods(self, cues, **options):
+        write_srt(self._srt_path, cues)
+        with patch.multiple(condenser, **options):
+            return condenser.extract_periods(self._srt_path)
+
+    def testOverlapMerge(self):
+        periods = self._periods([(1000, 2000, "a"), (2500, 3000, "b"), (10000, 11000, "c")], padding=500)
+        self.assertEqual(periods, [[500, 3500], [9500, 11000]])
+
+    def testGapNotBridgedByDefault(self):
+        periods = self._periods([(1000, 2000, "a"), (3600, 4000, "b"), (10000, 11000, "c")], padding=500)
+        self.assertEqual(len(periods), 3)
+
+    def testMinGapToBridge(self):
+        cues = [(1000, 2000, "a"), (3600, 4000, "b"), (10000, 11000, "c")]
+        periods = self._periods(cues, padding=500, min_gap_to_bridge=600)
+        self.assertEqual(periods, [[500, 4500], [9500, 11000]])
+
+    def testMaxPeriodLength(self):
+        cues = [(1000, 2000, "a"), (3600, 4000, "b"), (5600, 6000, "c")]
+        periods = self._periods(cues, padding=500, min_gap_to_bridge=600, max_period_length=4000)
+        self.assertEqual(periods, [[500, 4500], [5100, 6000]])
+
+    def testMaxPeriodLengthKeepsOverlaps(self):
+        cues = [(1000, 3000, "a"), (3200, 6000, "b")]
+        periods = self._periods(cues, padding=500, max_period_length=1000)
+        self.assertEqual(periods, [[500, 6000]])
+
+    def testMinPeriodDuration(self):
+        cues = [(1000, 1100, "a"), (5000, 8000, "b")]
+        periods = self._periods(cues, padding=0, min_period_duration=500)
+        self.assertEqual(periods, [[5000, 8000]])
+
+    def testMinPeriodDurationDropsAll(self):
+        with self.assertRaises(condenser.SubtitleError):
+            self._periods([(1000, 1100, "a")], padding=0, min_period_duration=500)
+
+    def testPeriodStats(self):
+        stats = condenser.period_stats([[0, 1000], [2000, 4000]], 10000)
+        self.assertEqual(stats["period_count"], 2)
+        self.assertEqual(stats["kept_duration"], 3000)
+        self.assertAlmostEqual(stats["compression_ratio"], 0.3)
+        self.assertIsNone(condenser.period_stats([[0, 1000]])["compression_ratio"])
+
+
+class TestPlan(TempDirTestCase):
+    def testSubtitleSource(self):
+        self.assertEqual(condenser.subtitle_source(None), "embedded")
+        self.assertEqual(condenser.subtitle_source("video.srt"), "external")
+        self.assertEqual(condenser.subtitle_source("video.ASS"), "converted")
+
+    @patch.object(condenser, "output_format", "mp3")
+    def testEstimateOutputSize(self):
+        # 128 kbps for 10 seconds
+        self.assertEqual(condenser.estimate_output_size(10000), 160000)
+
+    @patch.object(condenser, "output_format", "mp3")
+    def testEstimateRuntime(self):
+        self.assertIsNone(condenser.estimate_runtime(10, []))
+        samples = [
+            {"output_format": "mp3", "period_count": 100, "kept_duration": 60000, "elapsed": 5.0},
+            {"output_format": "mp3", "period_count": 300, "kept_duration": 90000, "elapsed": 15.0},
+            {"output_format": "flac", "period_count": 10, "kept_duration": 60000, "elapsed": 50.0},
+        ]
+        self.assertAlmostEqual(condenser.estimate_runtime(40, samples), 2.0)
+
+    def testBenchmarkRecording(self):
+        with patch.multiple(
+            condenser, benchmark_path=op.join(self._temp_dir, "benchmarks.json"), max_benchmark_samples=2
+        ):
+            for elapsed in (1.0, 2.0, 3.0):
+                condenser.record_benchmark({"period_count": 10, "kept_duration": 1000}, elapsed)
+            samples = condenser.load_benchmarks()
+        self.assertEqual([s["elapsed"] for s in samples], [2.0, 3.0])
+
+    def testWriteJsonReplacesAtOnce(self):
+        path = op.join(self._temp_dir, "benchmarks.json")
+        condenser.write_json(path, [1])
+        with patch.object(condenser.json, "dump", side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                condenser.write_json(path, [2])
+        # A failed write leaves the previous file whole
+        with open(path, encoding="utf8") as f:
+            self.assertEqual(json.load(f), [1])
+        self.assertEqual(os.listdir(self._temp_dir), ["benchmarks.json"])
+
+    @patch.object(condenser, "benchmark_path", None)
+    def testPlanEntry(self):
+        stats = condenser.period_stats([[0, 1000], [2000, 4000]], 10000)
+        entry = condenser.make_plan_entry("a.mkv", "a_con.mp3", 1, None, 2, stats)
+        self.assertEqual(entry["subtitle_source"], "embedded")
+        self.assertEqual(entry["subtitle_index"], 2)
+        self.assertEqual(entry["period_count"], 2)
+        self.assertIsNone(entry["estimated_runtime"])
+        json.dumps(entry)
+
+    @patch.multiple(condenser, dry_run=False, multi_track_output="separate", padding=0)
+    def testPlanOnlyDoesNotExtract(self):
+        with patch.object(condenser, "extract_periods", return_value=[[0, 1000]]):
+            with patch.object(condenser, "extract_audio_parts") as extract:
+                stats = condenser.condense("a.srt", "tmp", "a.mkv", 0, "a_con.mp3", 10000, plan_only=True)
+        extract.assert_not_called()
+        self.assertEqual(stats["period_count"], 1)
+        self.assertFalse(condenser.dry_run)
+
+    @unittest.skipUnless(shutil.which("ffmpeg") and shutil.which("ffprobe"), "Needs ffmpeg and ffprobe in PATH")
+    def testPlanRunsUnattended(self):
+        try:
+            folder = op.join(self._temp_dir, "videos")
+            os.makedirs(folder)
+            shutil.copy("test_files/inputs/3a2s.mkv", folder)
+            plan_path = op.join(self._temp_dir, "plan.json")
+            keys = ("ask_when_multiple_srt", "temp_budget_mb", "default_audio_stream", "default_subtitle_stream")
+            config_set(keys, (True, 1, 2, 1))
+            # Importing easygui fails, so any dialog would end the run without a plan
+            with patch.dict(sys.modules, {"easygui": None}):
+                main(folder, plan_path)
+            with open(plan_path, encoding="utf8") as f:
+                plan = json.load(f)
+            self.assertEqual([(entry["audio_index"], entry["subtitle_index"]) for entry in plan], [(2, 1)])
+            self.assertEqual(sorted(os.listdir(self._temp_dir)), ["plan.json", "videos"])
+        finally:
+            restore_config()
+
+
+class TestBitmapSubtitles(unittest.TestCase):
+    def testPgsPackets(self):
+        # PGS display sets have no duration and are followed by small "clear screen" sets
+        packets = [
+            {"pts_time": "1.000000", "size": "5000"},
+            {"pts_time": "2.500000", "size": "30"},
+            {"pts_time": "4.000000", "size": "6000"},
+            {"pts_time": "5.250000", "size": "30"},
+        ]
+        self.assertEqual(condenser.bitmap_packets_to_cues(packets), [[1000, 2500], [4000, 5250]])
+
+    def testPacketsWithDuration(self):
+        packets = [
+            {"pts_time": "3.000000", "duration_time": "1.500000", "size": "2000"},
+            {"pts_time": "1.000000", "duration_time": "0.500000", "size": "2000"},
+            {"size": "2000"},
+        ]
+        self.assertEqual(condenser.bitmap_packets_to_cues(packets), [[1000, 1500], [3000, 4500]])
+
+    def testLastPacketWithoutEnd(self):
+        packets = [{"pts_time": "1.000000", "size": "5000"}]
+        with patch.object(condenser, "bitmap_default_duration", 2000):
+            self.assertEqual(condenser.bitmap_packets_to_cues(packets), [[1000, 3000]])
+
+    @patch.object(condenser, "bitmap_max_duration", 10000)
+    def testMissingClearPacket(self):
+        # Without a clear packet, the cue would otherwise last until the next image
+        packets = [{"pts_time": "1.000000", "size": "5000"}, {"pts_time": "600.000000", "size": "5000"}]
+        with patch.object(condenser, "bitmap_default_duration", 3000):
+            self.assertEqual(condenser.bitmap_packets_to_cues(packets), [[1000, 11000], [600000, 603000]])
+
+    def testCachePath(self):
+        with patch.object(condenser, "cache_dir", None):
+            self.assertIsNone(condenser.bitmap_cache_path("test_files/inputs/1a0s.mkv", 0))
+        with patch.object(condenser, "cache_dir", "cache"):
+            path_0 = condenser.bitmap_cache_path("test_files/inputs/1a0s.mkv", 0)
+            path_1 = condenser.bitmap_cache_path("test_files/inputs/1a0s.mkv", 1)
+            self.assertNotEqual(path_0, path_1)
+            self.assertEqual(path_0, condenser.bitmap_cache_path("test_files/inputs/1a0s.mkv", 0))
+            # Timings cached with other cue options or by an older version are not reused
+            with patch.object(condenser, "bitmap_max_duration", 5000):
+                self.assertNotEqual(path_0, condenser.bitmap_cache_path("test_files/inputs/1a0s.mkv", 0))
+            with patch.object(condenser, "bitmap_cache_version", 1):
+                self.assertNotEqual(path_0, condenser.bitmap_cache_path("test_files/inputs/1a0s.mkv", 0))
+
+
+class TestWorkspace(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self._patcher = patch.multiple(condenser, scratch_dir=self._temp_dir, use_ram_disk=False, temp_budget_mb=0)
+        self._patcher.start()
+
+    def tearDown(self):
+        self._patcher.stop()
+        super().tearDown()
+
+    def testUsesScratchDirAndCleansUp(self):
+        with condenser.workspace(1000) as temp_dir:
+            self.assertEqual(op.dirname(temp_dir), self._temp_dir)
+            self.assertEqual(condenser.reserved_bytes(self._temp_dir), 1000)
+        self.assertFalse(op.exists(temp_dir))
+
+    def testCleansUpOnError(self):
+        with self.assertRaises(RuntimeError):
+            with condenser.workspace(1000) as temp_dir:
+                raise RuntimeError()
+        self.assertFalse(op.exists(temp_dir))
+
+    def testFallsBackWhenScratchIsFull(self):
+        free = shutil.disk_usage(self._temp_dir).free
+        with patch.object(condenser, "workspace_roots", return_value=[self._temp_dir, tempfile.gettempdir()]):
+            temp_dir = condenser.acquire_workspace(free + 1)
+        try:
+            self.assertEqual(op.dirname(temp_dir), tempfile.gettempdir())
+        finally:
+            condenser.release_workspace(temp_dir)
+
+    def _makeWorkspace(self, name, age=0):
+        path = op.join(self._temp_dir, name)
+        os.makedirs(path)
+        with open(op.join(path, condenser.workspace_lock_name), "wb"):
+            pass
+        os.utime(path, (time.time() - age, time.time() - age))
+        return path
+
+    def testOrphanCleanup(self):
+        # A crashed run with the same pid as this one, e.g. after a reboot, left its workspace behind
+        orphan = self._makeWorkspace(f"condenser_temp-host-{os.getpid()}-0-100", age=3600)
+        legacy = self._makeWorkspace(f"condenser_temp-{os.getpid()}-0-100", age=3600)
+        # A run on another host or in another pid namespace still holds its lock
+        live = self._makeWorkspace("condenser_temp-other-1-0-100", age=3600)
+        starting = self._makeWorkspace("condenser_temp-other-2-0-100")
+        with open(op.join(live, condenser.workspace_lock_name), "r+b") as lock:
+            self.assertTrue(condenser.lock_file(lock))
+            condenser.cleanup_orphaned_workspaces()
+        self.assertFalse(op.exists(orphan))
+        self.assertFalse(op.exists(legacy))
+        self.assertTrue(op.exists(live))
+        self.assertTrue(op.exists(starting))
+
+    def testOrphanDoesNotBlockBudget(self):
+        self._makeWorkspace(f"condenser_temp-host-{os.getpid()}-0-{1024 * 1024}", age=3600)
+        with patch.object(condenser, "temp_budget_mb", 1), patch("time.sleep") as sleep:
+            with condenser.workspace(1024 * 1024):
+                sleep.assert_not_called()
+
+    def testBudgetWaitsForOtherJobs(self):
+        other = op.join(self._temp_dir, f"condenser_temp-host-{os.getpid()}-0-{1024 * 1024}")
+        os.makedirs(other)
+
+        def finish_other_job(_):
+            shutil.rmtree(other)
+
+        with patch.object(condenser, "temp_budget_mb", 1), patch("time.sleep", side_effect=finish_other_job) as sleep:
+            with condenser.workspace(1024):
+                self.assertEqual(sleep.call_count, 1)
+
+    def testEstimateWorkspaceSize(self):
+        streams = [{"sample_rate": "44100", "channels": 2}, {"sample_rate": "48000", "channels": 6}]
+        self.assertEqual(condenser.estimate_workspace_size(1000, streams), 48000 * 6 * 2)
+        self.assertIsNone(condenser.estimate_workspace_size(None, streams))
+        with patch.object(condenser, "extra_audio_streams", [0, 0, 5]):
+            self.assertEqual(condenser.estimate_workspace_size(1000, streams), 48000 * 6 * 2 + 44100 * 2 * 2)
+
+    def testUnknownSizeUsesSystemTemp(self):
+        with patch.object(condenser, "workspace_roots", return_value=[self._temp_dir, tempfile.gettempdir()]):
+            with condenser.workspace(None) as temp_dir:
+                self.assertEqual(op.dirname(temp_dir), tempfile.gettempdir())
+
+    def testJobsStartedTogetherSeeEachOther(self):
+        # Another job made its reservation right after this one, but has not checked the budget yet
+        later_ms = int(time.time() * 1000) + 60000
+        later = op.join(self._temp_dir, f"condenser_temp-host-{os.getpid()}-{later_ms}-{1024}")
+        os.makedirs(later)
+        with patch.object(condenser, "temp_budget_mb", 1), patch("time.sleep") as sleep:
+            with condenser.workspace(1024 * 1024) as temp_dir:
+                sleep.assert_not_called()
+                self.assertEqual(condenser.reserved_bytes_ahead(later), [1024 * 1024])
+                self.assertEqual(condenser.reserved_bytes_ahead(temp_dir), [])
+
+
+class TestStartup(TempDirTestCase):
+    def testStartupBenchmark(self):
+        code = (
+            "import json, sys, time\n"
+            "start = time.perf_counter()\n"
+            "import condenser\n"
+            "elapsed = time.perf_counter() - start\n"
+            "print(json.dumps({'elapsed': elapsed, 'modules': sorted(sys.modules)}))\n"
+        )
+        result = sp.run([sys.executable, "-c", code], capture_output=True, check=True)
+        report = json.loads(result.stdout)
+        print("Importing condenser took {:.1f} ms".format(report["elapsed"] * 1000))
+        for module in ("easygui", "tkinter", "pysrt"):
+            self.assertNotIn(module, report["modules"])
+
+    @unittest.skipIf(sys.platform == "win32", "Uses a shell script as a fake ffmpeg")
+    def testBinaryCheckIsCached(self):
+        try:
+            fake_ffmpeg = op.join(self._temp_dir, "ffmpeg")
+            with open(fake_ffmpeg, "w") as f:
+                f.write("#!/bin/sh\necho 'ffmpeg version test'\n")
+            os.chmod(fake_ffmpeg, 0o755)
+
+            with patch.object(condenser, "cache_dir", op.join(self._temp_dir, "cache")):
+                condenser.check_binary.cache_clear()
+                self.assertEqual(condenser.check_binary(fake_ffmpeg), "ffmpeg version test")
+                condenser.check_binary.cache_clear()
+                with patch("subprocess.run") as mock_run:
+                    self.assertEqual(condenser.check_binary(fake_ffmpeg), "ffmpeg version test")
+                    mock_run.assert_not_called()
+        finally:
+            condenser.check_binary.cache_clear()
+
+    def testMissingSystemFfmpeg(self):
+        with patch.object(condenser, "which", return_value=None):
+            with self.assertRaises(condenser.MediaError):
+                condenser.resolve_ffmpeg(True)
+
+
+class TestAudioConditioning(unittest.TestCase):
+    _ebur128_log = """[Parsed_ebur128_0 @ 0x0] Summary:
+
+  Integrated loudness:
+    I:         -23.5 LUFS
+    Threshold: -33.9 LUFS
+
+  Loudness range:
+    LRA:         6.2 LU
+    Threshold: -43.8 LUFS
+    LRA low:   -27.1 LUFS
+    LRA high:  -20.9 LUFS
+
+  True peak:
+    Peak:       -3.4 dBFS
+"""
+
+    def testParseEbur128Summary(self):
+        self.assertEqual(condenser.parse_ebur128_summary(self._ebur128_log), {"I": -23.5, "LRA": 6.2, "TP": -3.4})
+        self.assertIsNone(condenser.parse_ebur128_summary("no summary"))
+
+    def testCombineLoudness(self):
+        measurements = [{"I": -20.0, "LRA": 4.0, "TP": -2.0}, {"I": -20.0, "LRA": 8.0, "TP": -1.0}, None]
+        loudness = condenser.combine_loudness(measurements, [1000, 3000, 500])
+        self.assertAlmostEqual(loudness["I"], -20.0)
+        self.assertAlmostEqual(loudness["LRA"], 7.0)
+        self.assertEqual(loudness["TP"], -1.0)
+        self.assertAlmostEqual(loudness["thresh"], -30.0)
+
+        # A part that is 10 dB louder has 10 times the energy
+        measurements = [{"I": -30.0, "LRA": 0.0, "TP": -9.0}, {"I": -20.0, "LRA": 0.0, "TP": -1.0}]
+        loudness = condenser.combine_loudness(measurements, [1000, 1000])
+        self.assertAlmostEqual(loudness["I"], 10 * math.log10(5.5 / 1000))
+        self.assertIsNone(condenser.combine_loudness([{"I": -70.0, "LRA": 0.0, "TP": -90.0}], [1000]))
+
+    def testLoudnormFilter(self):
+        with patch.multiple(condenser, loudnorm_target=-16.0, loudnorm_true_peak=-1.5, loudnorm_lra=11.0):
+            self.assertEqual(condenser.loudnorm_filter(None), "loudnorm=I=-16.0:TP=-1.5:LRA=11.0")
+            two_pass = condenser.loudnorm_filter({"I": -23.5, "LRA": 6.2, "TP": -3.4, "thresh": -33.5})
+        self.assertIn("measured_I=-23.50", two_pass)
+        self.assertIn("measured_thresh=-33.50", two_pass)
+        self.assertTrue(two_pass.endswith("linear=true"))
+
+    def testPartAudioFilters(self):
+        with patch.multiple(condenser, audio_channels=0, audio_sample_rate=0, boundary_fade=0, loudnorm=False):
+            self.assertEqual(condenser.part_audio_filters(1000), [])
+        with patch.multiple(condenser, audio_channels=1, audio_sample_rate=22050, boundary_fade=20, loudnorm=True):
+            filters = condenser.part_audio_filters(1000)
+        self.assertEqual(
+            filters,
+            [
+                "aformat=sample_rates=22050:channel_layouts=mono",
+                "afade=t=in:d=0.02",
+                "afade=t=out:st=0.98:d=0.02",
+                "ebur128=framelog=quiet:peak=true",
+            ],
+        )
+
+    def testBoundaryFadeFitsShortParts(self):
+        with patch.multiple(condenser, audio_channels=0, audio_sample_rate=0, boundary_fade=500, loudnorm=False):
+            self.assertEqual(condenser.part_audio_filters(400), ["afade=t=in:d=0.2", "afade=t=out:st=0.2:d=0.2"])
+
+
+class TestSegments(TempDirTestCase):
+    @patch.object(condenser, "segment_duration", 10)
+    def testSegmentCuts(self):
+        # Condensed period boundaries are at 6, 12, 15, 27 and 30 seconds
+        periods = [[0, 6000], [10000, 16000], [20000, 23000], [30000, 42000], [50000, 53000]]
+        self.assertEqual(condenser.segment_cuts(periods), [12000, 27000])
+
+    @patch.object(condenser, "segment_duration", 100)
+    def testNoCutsForShortOutput(self):
+        self.assertEqual(condenser.segment_cuts([[0, 6000], [10000, 16000]]), [])
+
+    @patch.multiple(condenser, segment_duration=100, segment_playlist=False, output_chapters=False, loudnorm=False)
+    def testSingleSegmentCommand(self):
+        with patch.object(condenser.sp, "run") as run:
+            run.return_value.returncode = 0
+            condenser.concatenate_audio_parts(
+                [[0, 6000], [10000, 16500]], self._temp_dir, [["a.flac", "b.flac"]], "dir/video_con.mp3"
+            )
+        command = run.call_args[0][0]
+        self.assertNotIn("-segment_times", command)
+        self.assertEqual(command[command.index("-segment_time") + 1], "13")
+        self.assertEqual(command[-1], "dir/video_con_%03d.mp3")
+
+    def testSegmentPath(self):
+        self.assertEqual(condenser.segment_path("dir/video_con.mp3", 7), "dir/video_con_007.mp3")
+
+    def testSplitSubtitles(self):
+        srt_path = op.join(self._temp_dir, "video_con.srt")
+        write_srt(srt_path, [(0, 1000, "a"), (2000, 5000, "b"), (6000, 7000, "c"), (9000, 9500, "d")])
+        paths = condenser.split_subtitles(srt_path, [6000])
+        self.assertFalse(op.exists(srt_path))
+        self.assertEqual([op.basename(p) for p in paths], ["video_con_000.srt", "video_con_001.srt"])
+
+        second = pysrt.open(paths[1])
+        self.assertEqual(
+            [(sub.start.ordinal, sub.end.ordinal, sub.text) for sub in second], [(0, 1000, "c"), (3000, 3500, "d")]
+        )
+        self.assertEqual(len(pysrt.open(paths[0])), 2)
+
+    def testWriteChapters(self):
+        metadata_path = op.join(self._temp_dir, "chapters.txt")
+        condenser.write_chapters([[1000, 3000], [3725000, 3726000]], metadata_path)
+        with open(metadata_path, encoding="utf8") as f:
+            metadata = f.read()
+        self.assertTrue(metadata.startswith(";FFMETADATA1\n"))
+        self.assertIn("START=0\nEND=2000\ntitle=00:00:01", metadata)
+        self.assertIn("START=2000\nEND=3000\ntitle=01:02:05", metadata)
+
+
+class TestMultiTrack(TempDirTestCase):
+    def testParseEbur128Summaries(self):
+        log = TestAudioConditioning._ebur128_log + TestAudioConditioning._ebur128_log.replace("-23.5", "-18.0")
+        summaries = condenser.parse_ebur128_summaries(log)
+        self.assertEqual([m["I"] for m in summaries], [-23.5, -18.0])
+
+    @patch.object(condenser, "extra_audio_streams", [0, 1, 2, 5])
+    def testExtraAudioIndices(self):
+        streams = [{}, {}, {}]
+        self.assertEqual(condenser.get_extra_audio_indices(1, streams), [0, 2])
+
+    def testTrackOutputPath(self):
+        self.assertEqual(condenser.track_output_path("dir/video_con.mka", 2), "dir/video_con_track3.mka")
+
+    def testExtraSubtitleSuffixes(self):
+        video_path = op.join(self._temp_dir, "video.mkv")
+        write_srt(op.join(self._temp_dir, "video_en.srt"), [(0, 1000, "a")])
+        with patch.multiple(condenser, extra_subtitle_streams=[], extra_sub_suffixes=["_en", "_de"]):
+            extra_srts = condenser.get_extra_srts(video_path, [], self._temp_dir)
+        self.assertEqual(extra_srts, [(op.join(self._temp_dir, "video_en.srt"), "_en")])
+
+    @patch.multiple(condenser, multi_track_output="container", output_format="mp3")
+    def testContainerNeedsMultiStreamFormat(self):
+        with self.assertRaises(ValueError):
+            condenser.condense("video.srt", self._temp_dir, "video.mkv", 0, "video_con.mp3", 1000, [1])
+
+
+class TestTimelineMap(TempDirTestCase):
+    _periods = [[1000, 3000], [5000, 6000], [10000, 14000]]
+
+    def testTimelineFromPeriods(self):
+        timeline = condenser.timeline_from_periods(self._periods)
+        self.assertEqual(timeline, [[0, 1000, 2000], [2000, 5000, 1000], [3000, 10000, 4000]])
+
+    def testWriteAndLoad(self):
+        path = op.join(self._temp_dir, "video_con.timeline.json")
+        condenser.write_timeline_map(self._periods, path)
+        self.assertEqual(condenser.load_timeline_map(path), condenser.timeline_from_periods(self._periods))
+
+    def testCondensedToSource(self):
+        timeline = condenser.timeline_from_periods(self._periods)
+        self.assertEqual(condenser.condensed_to_source(timeline, 0), 1000)
+        self.assertEqual(condenser.condensed_to_source(timeline, 1999), 2999)
+        self.assertEqual(condenser.condensed_to_source(timeline, 2000), 5000)
+        self.assertEqual(condenser.condensed_to_source(timeline, 3500), 10500)
+        self.assertEqual(condenser.condensed_to_source(timeline, 99999), 14000)
+
+    def testSourceToCondensed(self):
+        timeline = condenser.timeline_from_periods(self._periods)
+        self.assertEqual(condenser.source_to_condensed(timeline, 0), 0)
+        self.assertEqual(condenser.source_to_condensed(timeline, 1500), 500)
+        self.assertEqual(condenser.source_to_condensed(timeline, 4000), 2000)
+        self.assertEqual(condenser.source_to_condensed(timeline, 10500), 3500)
+        self.assertEqual(condenser.source_to_condensed(timeline, 99999), 7000)
+
+    def testRoundTrip(self):
+        timeline = condenser.timeline_from_periods(self._periods)
+        for t in range(0, 7000, 7):
+            self.assertEqual(condenser.source_to_condensed(timeline, condenser.condensed_to_source(timeline, t)), t)
+
+
+# (text, whether it is kept after filtering) pairs for synthetic subtitles. {} is replaced with the cue id when possible
+synthetic_texts = [
+    ("line {}", True),
+    ("<i>line {}</i>", True),
+    ("\u266a line {} \u266a", True),
+    ("(aside {})", False),
+    ("[music {}]", False),
+    ("\u266a\u266a", False),
+    ("<i></i>", False),
+]
+
+
+def random_cues(rng, count, shuffle=False, max_gap=30000, max_length=20000):
+    """Generates cues with random overlaps, zero-length and filtered lines. Returns (start, end, text, kept) tuples"""
+    cues = []
+    start = rng.randint(0, 2000)
+    for i in range(count):
+        start += rng.choice([0, 0, rng.randint(0, 800), rng.randint(0, max_gap // 6), rng.randint(0, max_gap)])
+        length = rng.choice([0, rng.randint(1, 400), rng.randint(400, max_length // 3), rng.randint(0, max_length)])
+        text, kept = rng.choices(synthetic_texts, weights=[10, 2, 2, 1, 1, 1, 1])[0]
+        cues.append((start, start + length, text.format(i), kept))
+    if shuffle:
+        rng.shuffle(cues)
+    return cues
+
+
+def reference_periods(cues, padding, min_gap=0):
+    """Straightforward interval union, to check extract_periods against"""
+    intervals = sorted([s - padding, e + padding] for s, e, _, kept in cues if kept)
+    intervals[0][0] = max(intervals[0][0], 0)
+    intervals[-1][1] -= padding
+    merged = []
+    for start, end in intervals:
+        if merged and start <= merged[-1][1] + min_gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [p for p in merged if p[1] > p[0]]
+
+
+def reference_condensed_subtitles(periods, cues):
+    condensed = []
+    offset = 0
+    for period_start, period_end in periods:
+        for start, end, text, _ in cues:
+            if start >= period_start and end <= period_end:
+                condensed.append((start - period_start + offset, end - period_start + offset, text))
+        offset += period_end - period_start
+    return condensed
+
+
+class TestPeriodInvariants(TempDirTestCase):
+    _filter_options = {"filtered_chars": "\u266a", "filter_parentheses": True}
+
+    def setUp(self):
+        super().setUp()
+        self._srt_path = op.join(self._temp_dir, "synthetic.srt")
+
+    def _extract(self, cues, **options):
+        write_srt(self._srt_path, [(s, e, t) for s, e, t, _ in cues])
+        defaults = {"min_gap_to_bridge": 0, "max_period_length": 0, "min_period_duration": 0}
+        with patch.multiple(condenser, **{**defaults, **self._filter_options, **options}):
+            return condenser.extract_periods(self._srt_path)
+
+    def _condense(self, periods, cues):
+        write_srt(self._srt_path, [(s, e, t) for s, e, t, _ in cues])
+        condensed_path = op.join(self._temp_dir, "condensed.srt")
+        condenser.condense_subtitles(periods, self._srt_path, condensed_path)
+        return [(sub.start.ordinal, sub.end.ordinal, sub.text) for sub in pysrt.open(condensed_path)]
+
+    def _checkInvariants(self, periods, cues, padding, min_gap=0):
+        for (_, prev_end), (start, _) in zip(periods, periods[1:], strict=False):
+            self.assertGreater(start, prev_end + min_gap)
+        for start, end in periods:
+            self.assertGreater(end, start)
+            self.assertGreaterEqual(start, 0)
+
+        # No kept line may lose any of its audio
+        period_starts = [start for start, _ in periods]
+        for start, end, _, kept in cues:
+            if not kept or (end == start and padding == 0):
+                continue
+            i = bisect.bisect_right(period_starts, max(start, 0)) - 1
+            self.assertGreaterEqual(i, 0)
+            self.assertLessEqual(end, periods[i][1])
+
+    def testMatchesReference(self):
+        for seed in range(20):
+            rng = random.Random(seed)
+            cues = random_cues(rng, 300, shuffle=seed % 2 == 1)
+            for padding in (0, 250, 500):
+                for min_gap in (0, 700):
+                    with self.subTest(seed=seed, padding=padding, min_gap=min_gap):
+                        periods = self._extract(cues, padding=padding, min_gap_to_bridge=min_gap)
+                        self.assertEqual(periods, reference_periods(cues, padding, min_gap))
+                        self._checkInvariants(periods, cues, padding, min_gap)
+
+    def testAtScale(self):
+        rng = random.Random(1234)
+        cues = random_cues(rng, 5000, shuffle=True)
+        for padding in (0, 500):
+            periods = self._extract(cues, padding=padding)
+            self.assertEqual(periods, reference_periods(cues, padding))
+            self._checkInvariants(periods, cues, padding)
+
+    def testMaxPeriodLengthInvariants(self):
+        rng = random.Random(99)
+        cues = random_cues(rng, 2000)
+        periods = self._extract(cues, padding=500, min_gap_to_bridge=3000, max_period_length=10000)
+        self._checkInvariants(periods, cues, 500)
+        # Periods can only be longer than the limit when their lines overlap
+        unbridged = reference_periods(cues, 500)
+        for start, end in periods:
+            if end - start > 10000:
+                self.assertIn([start, end], unbridged)
+
+    def testCondensedSubtitlesMatchReference(self):
+        for seed in range(10):
+            rng = random.Random(seed)
+            cues = random_cues(rng, 300, shuffle=seed % 2 == 1)
+            with self.subTest(seed=seed):
+                periods = self._extract(cues, padding=500)
+                self.assertEqual(self._condense(periods, cues), reference_condensed_subtitles(periods, cues))
+
+    def testCondensedSubtitlesAtScale(self):
+        rng = random.Random(4321)
+        cues = random_cues(rng, 5000, shuffle=True)
+        periods = self._extract(cues, padding=500)
+        condensed = self._condense(periods, cues)
+        total_duration = sum(end - start for start, end in periods)
+
+        # Only the lines with an id in their text can be told apart
+        original_lengths = {text: end - start for start, end, text, _ in cues if any(c.isdigit() for c in text)}
+        for start, end, text in condensed:
+            self.assertGreaterEqual(start, 0)
+            self.assertLessEqual(end, total_duration)
+            if text in original_lengths:
+                self.assertEqual(end - start, original_lengths[text])
+        condensed_texts = {text for _, _, text in condensed}
+        for _, _, text, kept in cues:
+            if kept:
+                self.assertIn(text, condensed_texts)
+
+    def testAllFiltered(self):
+        with self.assertRaises(condenser.SubtitleError):
+            self._extract([(1000, 2000, "(aside)", False), (3000, 4000, "\u266a", False)], padding=500)
+
+
+@unittest.skipUnless(shutil.which("ffmpeg") and shutil.which("ffprobe"), "Needs ffmpeg and ffprobe in PATH")
+class TestSampleAccuracy(TempDirTestCase):
+    """Condenses a sawtooth where every sample encodes its own position"""
+
+    _sample_rate = 8000
+    _duration = 600
+    _cue_count = 1000
+    _max_sample_error = 1
+
+    def _writeMarkedAudio(self, path):
+        sample_count = self._sample_rate * self._duration
+        with wave.open(path, "wb") as f:
+            f.setnchannels(2)
+            f.setsampwidth(2)
+            f.setframerate(self._sample_rate)
+            # The low word of the position is in the left channel and the high word in the right one
+            words = ((n % 65536 - 32768, n // 65536 - 32768) for n in range(sample_count))
+            samples = array.array("h", (word for frame in words for word in frame))
+            if sys.byteorder == "big":
+                samples.byteswap()
+            f.writeframes(samples.tobytes())
+
+    def testPeriodPlacement(self):
+        input_path = op.join(self._temp_dir, "marked.wav")
+        srt_path = op.join(self._temp_dir, "marked.srt")
+        output_path = op.join(self._temp_dir, "marked_con.wav")
+        self._writeMarkedAudio(input_path)
+        rng = random.Random(7)
+        cues = random_cues(rng, self._cue_count, max_gap=3000, max_length=2000)
+        self.assertLess(cues[-1][1], self._duration * 1000)
+        write_srt(srt_path, [(s, e, t) for s, e, t, _ in cues])
+
+        options = {
+            "ffmpeg_cmd": shutil.which("ffmpeg"),
+            "ffprobe_cmd": shutil.which("ffprobe"),
+            "output_format": "wav",
+            "padding": 100,
+            "output_timeline_map": True,
+            "output_condensed_subtitles": False,
+            "benchmark_path": None,
+            "dry_run": False,
+        }
+        workspace_dir = op.join(self._temp_dir, "work")
+        os.makedirs(workspace_dir)
+        with patch.multiple(condenser, **options):
+            condenser.condense(srt_path, workspace_dir, input_path, 0, output_path)
+        timeline = condenser.load_timeline_map(op.join(self._temp_dir, "marked_con.timeline.json"))
+
+        samples = array.array("h")
+        with wave.open(output_path, "rb") as f:
+            samples.frombytes(f.readframes(f.getnframes()))
+        if sys.byteorder == "big":
+            samples.byteswap()
+        positions = [
+            (low + 32768) + (high + 32768) * 65536 for low, high in zip(samples[::2], samples[1::2], strict=True)
+        ]
+        samples_per_ms = self._sample_rate // 1000
+        total_duration = sum(duration for _, _, duration in timeline)
+        self.assertLessEqual(abs(len(positions) - total_duration * samples_per_ms), self._max_sample_error)
+
+        for condensed_start, source_start, duration in timeline:
+            first = condensed_start * samples_per_ms
+            last = (condensed_start + duration) * samples_per_ms - 1
+            for k in (first, (first + last) // 2, last):
+                if k >= len(positions):
+                    continue
+                error = abs(positions[k] - (source_start * samples_per_ms + k - first))
+                self.assertLessEqual(error, self._max_sample_error, f"Period at {source_start} ms is misplaced")
+
+
+class TestEncodeProfiles(TempDirTestCase):
+    _profiles = {
+        "fast": {"intermediate_format": "pcm", "bitrate": "96k", "threads": 2},
+        "archival": {"codec": "libmp3lame", "quality": 0, "compression_level": 0, "sample_format": "s16p"},
+    }
+
+    @patch.object(condenser, "encode_profile", None)
+    def testNoProfile(self):
+        self.assertEqual(condenser.encode_options(), [])
+        self.assertEqual(condenser.intermediate_format_options(), ("flac", ["-c:a", "flac", "-compression_level", "0"]))
+
+    def testEncodeOptions(self):
+        with patch.multiple(condenser, encode_profiles=self._profiles, encode_profile="fast"):
+            self.assertEqual(condenser.encode_options(), ["-b:a", "96k", "-threads", "2"])
+            self.assertEqual(condenser.intermediate_format_options(), ("wav", ["-c:a", "pcm_s16le"]))
+        with patch.multiple(condenser, encode_profiles=self._profiles, encode_profile="archival"):
+            self.assertEqual(
+                condenser.encode_options(),
+                ["-c:a", "libmp3lame", "-q:a", "0", "-compression_level", "0", "-sample_fmt", "s16p"],
+            )
+            self.assertEqual(condenser.intermediate_format_options()[0], "flac")
+
+    def testProfileOutputSizeAndBenchmarks(self):
+        self.assertEqual(condenser.parse_bitrate("96k"), 96)
+        self.assertEqual(condenser.parse_bitrate(320000), 320)
+        self.assertIsNone(condenser.parse_bitrate(None))
+        with patch.multiple(condenser, encode_profiles=self._profiles, output_format="mp3"):
+            with patch.object(condenser, "encode_profile", "fast"):
+                self.assertEqual(condenser.estimate_output_size(10000), 120000)
+                samples = [
+                    {"output_format": "mp3", "encode_profile": "fast", "period_count": 10, "elapsed": 1.0},
+                    {"output_format": "mp3", "encode_profile": None, "period_count": 10, "elapsed": 5.0},
+                ]
+                self.assertAlmostEqual(condenser.estimate_runtime(10, samples), 1.0)
+            with patch.object(condenser, "encode_profile", "archival"):
+                # No bitrate in the profile, so the format's typical bitrate is used
+                self.assertEqual(condenser.estimate_output_size(10000), 160000)
+        with patch.multiple(condenser, encode_profiles=self._profiles, encode_profile="fast", output_format="flac"):
+            self.assertEqual(condenser.estimate_output_size(1000), 87500)
+
+    def testBenchmarkRecordsProfile(self):
+        options = {"benchmark_path": op.join(self._temp_dir, "benchmarks.json"), "encode_profiles": self._profiles}
+        with patch.multiple(condenser, encode_profile="fast", **options):
+            condenser.record_benchmark({"period_count": 10, "kept_duration": 1000}, 1.0)
+            sample = condenser.load_benchmarks()[0]
+        self.assertEqual((sample["encode_profile"], sample["intermediate_format"]), ("fast", "wav"))
+
+    @patch.multiple(condenser, output_format="mp3", encode_profile=None, load_config=lambda _: None)
+    @patch.multiple(condenser, setup_binaries=lambda: None, get_srt=lambda *_: ("video.srt", None, None))
+    def testBenchmarkKeepsExistingOutputs(self):
+        runs = []
+
+        def fake_condense(srt_path, work_dir, filename, audio_index, output_filename, *_):
+            runs.append((condenser.encode_profile, op.dirname(output_filename)))
+            for suffix in ("_000.mp3", "_001.mp3", ".srt", ".timeline.json"):
+                with open(op.splitext(output_filename)[0] + suffix, "wb") as f:
+                    f.write(b"x" * 100)
+
+        video = op.join(self._temp_dir, "video.mkv")
+        existing = op.join(self._temp_dir, "video_con.mp3")
+        for path in (video, existing):
+            with open(path, "wb"):
+                pass
+        probe = ([{"sample_rate": "44100", "channels": 2}], [], 60000)
+        with patch.multiple(condenser, encode_profiles=self._profiles, probe_video=lambda _: probe):
+            with patch.object(condenser, "condense", side_effect=fake_condense):
+                results = condenser.benchmark_encode_profiles(video)
+            with patch.object(condenser, "condense", side_effect=condenser.MediaError("failed")):
+                self.assertRaises(condenser.MediaError, condenser.benchmark_encode_profiles, video)
+        self.assertTrue(op.isfile(existing))
+        self.assertEqual([(r["profile"], r["output_size"]) for r in results], [("fast", 200), ("archival", 200)])
+        # The first run is an untimed warm-up with the configured profile
+        self.assertEqual([profile for profile, _ in runs], [None, "fast", "archival"])
+        self.assertIsNone(condenser.encode_profile)
+        self.assertFalse(any(op.exists(d) for _, d in runs))
+
+    @patch.multiple(condenser, encode_profile="fast", loudnorm=False, boundary_fade=0, audio_channels=0)
+    @patch.multiple(condenser, audio_sample_rate=0, ffmpeg_cmd="ffmpeg")
+    def testPcmIntermediateParts(self):
+        with patch.object(condenser.sp, "run") as run:
+            run.return_value.returncode = 0
+            out_paths, _ = condenser.extract_audio_parts([[0, 1000], [2000, 3000]], "tmp", "video.mkv", [0])
+        self.assertEqual(out_paths, [["tmp/out_0_0.wav", "tmp/out_0_1.wav"]])
+        self.assertEqual(run.call_args[0][0][-3:], ["-c:a", "pcm_s16le", "tmp/out_0_1.wav"])
+
+
+class TestWatch(TempDirTestCase):
+    def _touch(self, name, mtime=None, content=b"x"):
+        path = op.join(self._temp_dir, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def testScanWatchFolder(self):
+        video = self._touch("video.mkv", 1000)
+        sub = self._touch("video.srt", 2000, b"xy")
+        other = self._touch("other.mp4", 3000)
+        self._touch("notes.txt")
+        signatures = condenser.scan_watch_folder(self._temp_dir)
+        self.assertEqual(signatures, {video: (1, 1000 * 10**9, sub, 2, 2000 * 10**9), other: (1, 3000 * 10**9, None)})
+        self.assertEqual(condenser.newest_signature_mtime(signatures[video]), 2000 * 10**9)
+
+    @patch.object(condenser, "watch_settle_time", 30)
+    def testSettledVideos(self):
+        seen = {}
+        old = ("old.mkv", (1, 100 * 10**9, None))
+        new = ("new.mkv", (1, 990 * 10**9, None))
+        ready, next_wait = condenser.settled_videos(dict([old, new]), seen, 1000)
+        # Files that were already there are ready right away, the others wait until they stop changing
+        self.assertEqual(ready, ["old.mkv"])
+        self.assertEqual(next_wait, 20)
+        seen["old.mkv"][2] = True
+
+        growing = (2, 1005 * 10**9, None)
+        ready, next_wait = condenser.settled_videos({"old.mkv": old[1], "new.mkv": growing}, seen, 1005)
+        self.assertEqual(ready, [])
+        self.assertEqual(next_wait, 30)
+        ready, next_wait = condenser.settled_videos({"old.mkv": old[1], "new.mkv": growing}, seen, 1035)
+        self.assertEqual(ready, ["new.mkv"])
+        self.assertIsNone(next_wait)
+        seen["new.mkv"][2] = True
+
+        # A subtitle that arrives later makes the video pending again, and removed files are forgotten
+        with_sub = (2, 1005 * 10**9, "new.srt", 1, 1040 * 10**9)
+        ready, next_wait = condenser.settled_videos({"new.mkv": with_sub}, seen, 1040)
+        self.assertEqual((ready, next_wait), ([], 30))
+        self.assertEqual(list(seen), ["new.mkv"])
+
+    @patch.object(condenser, "segment_duration", 0)
+    def testIsOutputUpToDate(self):
+        output = op.join(self._temp_dir, "video.mp3")
+        signature = (1, 2000 * 10**9, None)
+        self.assertFalse(condenser.is_output_up_to_date(output, signature))
+        self._touch("video.mp3", 1000)
+        self.assertFalse(condenser.is_output_up_to_date(output, signature))
+        self._touch("video.mp3", 3000)
+        self.assertTrue(condenser.is_output_up_to_date(output, signature))
+        self.assertFalse(condenser.is_output_up_to_date(output, signature + (1, 4000 * 10**9)))
+
+    @patch.multiple(condenser, watch_settle_time=0, output_format="mp3", fixed_output_dir=None, segment_duration=0)
+    def testOnlyChangedVideosAreCondensed(self):
+        video = self._touch("video.mkv", 1000)
+        self._touch("video.srt", 1000)
+        done = self._touch("done.mkv", 1000)
+        parent_folder, folder_name = op.split(self._temp_dir)
+        output_dir = condenser.folder_output_dir(parent_folder, folder_name)
+        os.makedirs(output_dir)
+        with open(op.join(output_dir, "done.mp3"), "wb"):
+            pass
+
+        seen = {}
+        ready, _ = condenser.settled_videos(condenser.scan_watch_folder(self._temp_dir), seen, 2000)
+        self.assertEqual(ready, [done, video])
+        with patch.object(condenser, "probe_video", return_value=([{}], [], 1000)) as probe:
+            with patch.object(condenser, "condense_multi") as condense_multi:
+                for path in ready:
+                    condenser.condense_watched_video(path, seen[path][0], parent_folder, folder_name)
+        probe.assert_called_once_with(video)
+        self.assertEqual(condense_multi.call_args[0][1], [video])
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "inotify is only available on Linux")
+    def testInotifyWakeUp(self):
+        fd = condenser.open_inotify(self._temp_dir)
+        self.assertIsNotNone(fd)
+        try:
+            self._touch("video.mkv")
+            start = condenser.timer()
+            condenser.wait_for_changes(fd, 5)
+            self.assertLess(condenser.timer() - start, 1)
+            start = condenser.timer()
+            condenser.wait_for_changes(fd, 0.1)
+            self.assertGreaterEqual(condenser.timer() - start, 0.09)
+        finally:
+            os.close(fd)
+
+    @patch.multiple(condenser, output_format="mp3", extra_sub_suffixes=["_en"])
+    def testOutputSetPaths(self):
+        names = [
+            "video.mp3",
+            "video_000.mp3",
+            "video_001.mp3",
+            "video.m3u8",
+            "video_track2.mp3",
+            "video_track2_000.mp3",
+            "video.srt",
+            "video_000.srt",
+            "video_en.srt",
+            "video_sub3.srt",
+            "video.timeline.json",
+            "video2.mp3",
+            "video_notes.txt",
+            "other.mp3",
+        ]
+        for name in names:
+            self._touch(name)
+        paths = condenser.output_set_paths(op.join(self._temp_dir, "video.mp3"))
+        self.assertEqual(sorted(op.basename(p) for p in paths), sorted(names[:11]))
+        # Outputs of other videos in the folder that look like segments or extra subtitles of this one are kept
+        for name in ["video_001.mp3", "video_en.mp3", "video_en.srt"]:
+            self._touch(name)
+        paths = condenser.output_set_paths(op.join(self._temp_dir, "video.mp3"), ["video_001", "video_en"])
+        self.assertEqual(
+            sorted(op.basename(p) for p in paths), sorted(set(names[:11]) - {"video_001.mp3", "video_en.srt"})
+        )
+
+    @patch.multiple(condenser, watch_settle_time=0, output_format="mp3", fixed_output_dir=None, segment_duration=0)
+    @patch.multiple(condenser, mulsrt_ask=True, default_audio_stream=1, default_subtitle_stream=5)
+    def testWatchModeNeverAsks(self):
+        video = self._touch("video.mkv")
+        parent_folder, folder_name = op.split(self._temp_dir)
+        output_dir = condenser.folder_output_dir(parent_folder, folder_name)
+        os.makedirs(output_dir)
+        # Left over from a run with more segments, next to the output of another video
+        self._touch("video_001.mkv")
+        for name in ("video_003.mp3", "video_001.mp3"):
+            with open(op.join(output_dir, name), "wb"):
+                pass
+        audio_streams = [{"codec_name": "aac"}, {"codec_name": "opus"}]
+        subtitle_streams = [{"codec_name": "subrip"}, {"codec_name": "ass"}]
+        try:
+            # Importing easygui fails, so any dialog would raise
+            with patch.dict(sys.modules, {"easygui": None}):
+                with patch.object(condenser, "probe_video", return_value=(audio_streams, subtitle_streams, 1000)):
+                    with patch.object(condenser, "extract_srt", return_value="out.srt") as extract_srt:
+                        with patch.object(condenser, "condense", return_value={}) as condense:
+                            condenser.condense_watched_video(video, (1, 0, None), parent_folder, folder_name)
+            self.assertEqual(extract_srt.call_args[0][2], 0)
+            self.assertEqual(condense.call_args[0][3], 1)
+            self.assertEqual(os.listdir(output_dir), ["video_001.mp3"])
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)